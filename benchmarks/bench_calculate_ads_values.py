@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Offline benchmark of the calculate_ads_values filter script
+
+Runs the filter outside Fledge on synthetic blocks of ADS readings, shaped like the readings the python35 filter
+receives: {'asset_code': ..., 'reading': {b'ANASEN_CH1': ..., ...}}. Every channel mix below is benchmarked with
+every implementation of the filter and every block size:
+
+Channel mixes:
+    default       the channel mapping and factors of plugins/filter/config.json
+    float         six scaled channels, VDC, ADC, Ambient, OIL level, OTI and WTI
+    oltc          six OLTC channels looked up in a tap table of --taps taps
+    null          six channels mapped to null, the readings pass through unchanged
+    sparse        the default mapping with --null-fraction of the channel values null in the readings
+
+Implementations, each a separately loaded copy of the filter module:
+    scalar        doit per reading, MIN_VECTOR_BLOCK 0
+    numpy         the NumPy batch mode, MIN_VECTOR_BLOCK 1, skipped when NumPy is not installed
+    profiles      the same factors as a calibration profile matching every asset
+    baseline      another revision of the filter file given with --baseline, e.g. one taken with git show
+
+Reported per mix:
+    config        microseconds per set_filter_config call
+    doit          microseconds per reading of doit on the default channel plan
+    blocks        microseconds per reading of calculate_ads_values for every block size and implementation
+
+The output of every implementation is compared with the scalar one, values and types, and the benchmark exits with
+status 1 when any reading differs. An implementation that raises on a mix, e.g. a baseline revision that does not
+handle null channel values, is reported and left out of that mix. --json saves the results and --compare reports
+the speedup of every block timing against the saved results of an earlier run.
+
+Usage:
+    python3 benchmarks/bench_calculate_ads_values.py
+    python3 benchmarks/bench_calculate_ads_values.py --mixes oltc --taps 500 --sizes 1,64,1024
+    git show HEAD~5:plugins/filter/calculate_ads_values.py > /tmp/ads_before.py
+    python3 benchmarks/bench_calculate_ads_values.py --baseline /tmp/ads_before.py --json after.json
+    python3 benchmarks/bench_calculate_ads_values.py --compare after.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_FILTER_DIR = os.path.join(os.path.dirname(_BENCH_DIR), 'plugins', 'filter')
+_FILTER_PATH = os.path.join(_FILTER_DIR, 'calculate_ads_values.py')
+
+MIXES = ('default', 'float', 'oltc', 'null', 'sparse')
+IMPLEMENTATIONS = ('scalar', 'numpy', 'profiles', 'baseline')
+
+# asset codes of the synthetic readings, the profiles implementation matches all of them
+_ASSETS = tuple('T{}_adstop_Feeder'.format(device) for device in range(8))
+
+_FLOAT_CHANNELS = ('VDC', 'ADC', 'Ambient', 'OIL level', 'OTI', 'WTI')
+
+
+def load_filter(path, name):
+    """ Imports a copy of the filter script, every copy keeps its own configuration """
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def mix_config(mix, taps):
+    """ Returns the filter configuration of a channel mix as a dictionary """
+    with open(os.path.join(_FILTER_DIR, 'config.json')) as config_file:
+        config = json.load(config_file)
+    if mix == 'float':
+        channels = _FLOAT_CHANNELS
+        config['config'] = [item for item in config['config'] if 'OLTC_TAP_CONFIG' in item or 'OLTC_SUB_FACTOR' in item]
+        config['config'] += [{'VDC_MULT_FACTOR': 0.0678}, {'ADC_DIV_FACTOR': 297.9}, {'ADC_SUB_FACTOR': 4},
+                             {'AMBIENT_MULT_FACTOR': 195}, {'AMBIENT_DIV_FACTOR': 3000},
+                             {'OIL_LEVEL_MULT_FACTOR': 50}, {'OIL_LEVEL_DIV_FACTOR': 1000},
+                             {'OTI_MULT_FACTOR': 250}, {'OTI_DIV_FACTOR': 3000}, {'OTI_SUB_FACTOR': 25},
+                             {'WTI_MULT_FACTOR': 1.5}]
+    elif mix == 'oltc':
+        channels = ('OLTC',) * 6
+        config['config'] = [item for item in config['config'] if 'OLTC_TAP_CONFIG' not in item]
+        config['config'].append({'OLTC_TAP_CONFIG': [{'Tap': tap + 1, 'Measured Value': 100 + 140 * tap}
+                                                     for tap in range(taps)]})
+    elif mix == 'null':
+        channels = (None,) * 6
+    else:
+        channels = None
+    if channels is not None:
+        config['ANALOG_CHANNELS'] = [{'Channel': index + 1, 'ANASEN_CH{}'.format(index + 1): channel}
+                                     for index, channel in enumerate(channels)]
+    return config
+
+
+def implementation_config(config, implementation):
+    """ Returns the configuration of an implementation as the filter receives it """
+    config = dict(config)
+    if implementation == 'scalar':
+        config['MIN_VECTOR_BLOCK'] = 0
+    elif implementation == 'numpy':
+        config['MIN_VECTOR_BLOCK'] = 1
+    elif implementation == 'profiles':
+        config['PROFILES'] = [{'pattern': '*'}]
+    return {'config': json.dumps(config)}
+
+
+def tap_range(config):
+    measured = [item['Measured Value'] for item in
+                [d for d in config['config'] if 'OLTC_TAP_CONFIG' in d][0]['OLTC_TAP_CONFIG']]
+    return min(measured) - 200, max(measured) + 200
+
+
+def make_readings(mix, config, count, null_fraction, rng):
+    """ Returns count random readings of a channel mix, the OLTC channels get values around the tap table """
+    low, high = tap_range(config)
+    readings = []
+    for index in range(count):
+        reading = {b'timestamp': '2025-06-15 12:30:{:02d}'.format(index % 60), b'IsNlf': 0}
+        for channel in range(1, 7):
+            if mix == 'oltc':
+                value = float(rng.randint(int(low), int(high)))
+            else:
+                value = round(rng.uniform(0, 3000), 1)
+            if mix == 'sparse' and rng.random() < null_fraction:
+                value = None
+            reading['ANASEN_CH{}'.format(channel).encode()] = value
+        readings.append({'asset_code': _ASSETS[index % len(_ASSETS)], 'reading': reading})
+    return readings
+
+
+def copy_readings(readings):
+    return [{'asset_code': elem['asset_code'], 'reading': dict(elem['reading'])} for elem in readings]
+
+
+def typed(readings):
+    """ Returns the readings with the type of every value, 2 and 2.0 compare equal otherwise """
+    return [sorted((key, type(value).__name__, value) for key, value in elem['reading'].items())
+            for elem in readings]
+
+
+def calculate(module, readings, size):
+    """ Returns the typed output of calculate_ads_values on copies of the readings in blocks of size readings """
+    output = copy_readings(readings)
+    for start in range(0, len(output), size):
+        module.calculate_ads_values(output[start:start + size])
+    return typed(output)
+
+
+def time_config(module, configuration, repeat):
+    """ Returns the median microseconds of a set_filter_config call """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        module.set_filter_config(configuration)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1e6
+
+
+def time_doit(module, readings, repeat):
+    """ Returns the best microseconds per reading of doit over the readings """
+    best = None
+    for _ in range(repeat):
+        copies = [dict(elem['reading']) for elem in readings]
+        doit = module.doit
+        start = time.perf_counter()
+        for reading in copies:
+            doit(reading)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(readings) * 1e6
+
+
+def time_blocks(module, readings, size, repeat):
+    """ Returns the best microseconds per reading of calculate_ads_values on blocks of size readings """
+    best = None
+    for _ in range(repeat):
+        blocks = [copy_readings(readings[start:start + size]) for start in range(0, len(readings), size)]
+        calculate = module.calculate_ads_values
+        start = time.perf_counter()
+        for block in blocks:
+            calculate(block)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(readings) * 1e6
+
+
+def run(args):
+    mixes = args.mixes.split(',')
+    for mix in mixes:
+        if mix not in MIXES:
+            raise SystemExit("Unknown channel mix {}, choose from {}".format(mix, ', '.join(MIXES)))
+    sizes = [int(size) for size in args.sizes.split(',')]
+    implementations = args.implementations.split(',')
+    for implementation in implementations:
+        if implementation not in IMPLEMENTATIONS:
+            raise SystemExit("Unknown implementation {}, choose from {}".format(
+                implementation, ', '.join(IMPLEMENTATIONS)))
+    if 'baseline' in implementations and not args.baseline:
+        implementations.remove('baseline')
+    if implementations[0] != 'scalar':
+        implementations.insert(0, 'scalar')
+
+    modules = {}
+    for implementation in implementations:
+        path = args.baseline if implementation == 'baseline' else _FILTER_PATH
+        modules[implementation] = load_filter(path, 'calculate_ads_values_' + implementation)
+    if 'numpy' in modules and getattr(modules['numpy'], 'np', None) is None:
+        print("NumPy is not installed, skipping the numpy implementation")
+        del modules['numpy']
+        implementations.remove('numpy')
+
+    rng = random.Random(args.seed)
+    result = {
+        'python': sys.version.split()[0],
+        'numpy': getattr(getattr(modules['scalar'], 'np', None), '__version__', None),
+        'readings': args.readings,
+        'taps': args.taps,
+        'baseline': args.baseline,
+        'config': {},
+        'doit': {},
+        'blocks': [],
+        'mismatches': [],
+        'errors': []
+    }
+    for mix in mixes:
+        config = mix_config(mix, args.taps)
+        readings = make_readings(mix, config, args.readings, args.null_fraction, rng)
+        check = readings[:args.check]
+        result['config'][mix] = {}
+        result['doit'][mix] = {}
+        expected = {}
+        for implementation in implementations:
+            module = modules[implementation]
+            configuration = implementation_config(config, implementation)
+            try:
+                result['config'][mix][implementation] = time_config(module, configuration, args.repeat * 20)
+                outputs = {size: calculate(module, check, size) for size in sizes}
+            except Exception as error:
+                # e.g. a baseline revision that does not handle null channel values
+                result['errors'].append({'mix': mix, 'implementation': implementation, 'error': repr(error)})
+                continue
+
+            for size, output in outputs.items():
+                if size not in expected:
+                    expected[size] = output
+                    continue
+                differing = sum(1 for got, want in zip(output, expected[size]) if got != want)
+                if differing:
+                    result['mismatches'].append({'mix': mix, 'size': size, 'implementation': implementation,
+                                                 'readings': differing})
+            if implementation in ('scalar', 'baseline'):
+                result['doit'][mix][implementation] = time_doit(module, readings, args.repeat)
+            for size in sizes:
+                result['blocks'].append({'mix': mix, 'size': size, 'implementation': implementation,
+                                         'usPerReading': time_blocks(module, readings, size, args.repeat)})
+    return result
+
+
+def print_results(result, previous):
+    """ Prints the timings, with the speedup against the previous results when there are any """
+    before = {}
+    if previous is not None:
+        before = {(row['mix'], row['size'], row['implementation']): row['usPerReading']
+                  for row in previous['blocks']}
+    for mix, timings in result['config'].items():
+        print("{}: set_filter_config {}  doit {}".format(
+            mix, '  '.join('{} {:.1f} us'.format(name, value) for name, value in timings.items()),
+            '  '.join('{} {:.2f} us/reading'.format(name, value) for name, value in result['doit'][mix].items())))
+    print("{:<8} {:>6} {:<10} {:>12} {:>10} {:>10}".format('mix', 'size', 'impl', 'us/reading', 'vs scalar',
+                                                           'vs before'))
+    scalar = {(row['mix'], row['size']): row['usPerReading'] for row in result['blocks']
+              if row['implementation'] == 'scalar'}
+    for row in result['blocks']:
+        key = (row['mix'], row['size'], row['implementation'])
+        value = row['usPerReading']
+        print("{:<8} {:>6} {:<10} {:>12.3f} {:>10} {:>10}".format(
+            row['mix'], row['size'], row['implementation'], value,
+            '{:.2f}x'.format(scalar[key[:2]] / value) if key[:2] in scalar else '-',
+            '{:.2f}x'.format(before[key] / value) if key in before else '-'))
+    for error in result['errors']:
+        print("ERROR {mix}: {implementation} failed with {error}".format(**error))
+    for mismatch in result['mismatches']:
+        print("MISMATCH {mix} size {size}: {readings} readings of {implementation} differ from scalar".format(
+            **mismatch))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the calculate_ads_values filter')
+    parser.add_argument('--mixes', default=','.join(MIXES), help='comma separated channel mixes, all by default')
+    parser.add_argument('--sizes', default='1,16,64,256,1024', help='comma separated block sizes')
+    parser.add_argument('--implementations', default='scalar,numpy,profiles,baseline',
+                        help='comma separated implementations, scalar is always run as the reference')
+    parser.add_argument('--baseline', help='another revision of calculate_ads_values.py to benchmark and check')
+    parser.add_argument('--readings', type=int, default=10000, help='readings per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs, the best one is reported')
+    parser.add_argument('--check', type=int, default=2048, help='readings compared across the implementations')
+    parser.add_argument('--taps', type=int, default=64, help='taps in the tap table of the oltc mix')
+    parser.add_argument('--null-fraction', type=float, default=0.3,
+                        help='fraction of null channel values in the sparse mix')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random readings')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run written with --json')
+    args = parser.parse_args(argv)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as json_file:
+            previous = json.load(json_file)
+    result = run(args)
+    print_results(result, previous)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(result, json_file, indent=2)
+    return 1 if result['mismatches'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
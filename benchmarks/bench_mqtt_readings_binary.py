@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Offline throughput benchmark of the mqtt-readings-binary south plugin
+
+Runs the plugin without a Fledge container and without a broker. The fledge.common, fledge.plugins.common.utils,
+fledge.services.south and async_ingest modules are replaced by the stand-ins in stubs/, the paho client is kept
+offline and synthetic paho MQTTMessage objects are fed straight into MqttSubscriberClient.on_message, the way the
+paho network thread does. The payloads are random records packed
+with the struct_format of every schema file of the plugin, e.g. adstop, ddstop, pdstop and pqstop.
+
+Reported per run:
+    msgs/s        messages decoded per second, from the first published message to the last ingested reading
+    p50/p99/max   latency from on_message to the ingest callback of every ingested reading, so it covers queueing,
+                  decoding, batching and the ingest call
+    peak RSS      peak resident set size of the benchmark process
+
+Usage:
+    python3 benchmarks/bench_mqtt_readings_binary.py --rate 1000 --devices 10 --duration 10
+    python3 benchmarks/bench_mqtt_readings_binary.py --streams pqstop --rate 0 --count 200000
+    python3 benchmarks/bench_mqtt_readings_binary.py --set batchDecode=true --set ingestBatchSize=500 --json out.json
+    python3 benchmarks/bench_mqtt_readings_binary.py --streams adstop --records 20 --rate 0 --count 20000
+
+A rate of 0 publishes as fast as possible. --set overrides a plugin configuration item and can be repeated.
+"""
+
+import argparse
+import array
+import collections
+import importlib.util
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+_BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+_PLUGIN_DIR = os.path.join(os.path.dirname(_BENCH_DIR), 'plugins', 'south', 'mqtt-readings-binary')
+
+# the stand-ins shadow any installed Fledge modules
+sys.path.insert(0, os.path.join(_BENCH_DIR, 'stubs'))
+
+import async_ingest  # noqa: E402
+import paho.mqtt.client as mqtt  # noqa: E402
+
+# number of distinct random payloads published per stream type and device
+_PAYLOAD_POOL = 16
+
+
+def load_plugin():
+    """ Imports the plugin module, its file name is not a valid module name """
+    spec = importlib.util.spec_from_file_location('mqtt_readings_binary', os.path.join(_PLUGIN_DIR,
+                                                                                       'mqtt-readings-binary.py'))
+    plugin = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(plugin)
+    return plugin
+
+
+def plugin_config(plugin, overrides):
+    """ Returns the plugin configuration with the default values and the overrides as values """
+    config = {name: dict(item, value=item.get('default', '')) for name, item in plugin._DEFAULT_CONFIG.items()}
+    for name, value in overrides.items():
+        if name not in config:
+            raise SystemExit("Unknown plugin configuration item {}".format(name))
+        config[name]['value'] = value
+    return config
+
+
+def random_payloads(schema, count, rng):
+    """ Returns count random records packed with the struct of a schema, the RTC trailer holds a valid time """
+    template = schema.struct.unpack(bytes(schema.size))
+    payloads = []
+    for index in range(count):
+        values = []
+        for value in template:
+            if isinstance(value, bool):
+                values.append(rng.random() < 0.5)
+            elif isinstance(value, float):
+                values.append(rng.uniform(0, 1000))
+            elif isinstance(value, int):
+                values.append(rng.randint(0, 1))
+            else:
+                values.append(value)
+        if schema.data_count != len(template):
+            # seconds, minutes, hours, weekday, date, month, year, IsNlf
+            values[schema.data_count:] = [index % 60, 30, 12, 3, 15, 6, 2025, False]
+        payloads.append(schema.struct.pack(*values))
+    return payloads
+
+
+def make_client_class(plugin):
+    """ Returns a MqttSubscriberClient that records the receive time of every reading it ingests """
+
+    class BenchClient(plugin.MqttSubscriberClient):
+
+        __slots__ = ['_received', 'received_times']
+
+        def __init__(self, config, schemas):
+            super().__init__(config, schemas)
+            self._received = 0.0
+            self.received_times = collections.deque()
+
+        async def save(self, route, topic, payload_data, received):
+            self._received = received
+            await super().save(route, topic, payload_data, received)
+
+        async def ingest(self, data):
+            # readings reach the ingest callback in the order they are ingested
+            self.received_times.append(self._received)
+            await super().ingest(data)
+
+    return BenchClient
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class OfflinePlugin(object):
+    """ The plugin with an offline paho client, its readings go to the stand-in ingest callback
+
+    Args:
+        overrides: plugin configuration values keyed by item name
+    """
+
+    def __init__(self, overrides):
+        self.overrides = overrides
+        self.plugin = load_plugin()
+        self.plugin.MqttSubscriberClient = make_client_class(self.plugin)
+        self.handle = self.plugin.plugin_init(plugin_config(self.plugin, overrides))
+        self.client = self.handle['_mqtt']
+
+        # the network thread idles until the plugin shuts down
+        offline = threading.Event()
+        self.client.mqtt_client.connect_async = lambda *a, **kw: None
+        self.client.mqtt_client.reconnect = lambda *a, **kw: None
+        self.client.mqtt_client.loop_forever = lambda *a, **kw: offline.wait()
+        self.client.mqtt_client.disconnect = lambda *a, **kw: offline.set()
+
+        self.latencies = array.array('d')
+        self.started = 0.0
+        self.last_ingest = 0.0
+        self.last_publish = 0.0
+        self.published = 0
+        async_ingest.sink = self._sink
+        self.plugin.plugin_register_ingest(self.handle, None, None)
+
+    def _sink(self, readings):
+        now = time.monotonic()
+        received_times = self.client.received_times
+        for _ in readings:
+            self.latencies.append(now - received_times.popleft())
+        self.last_ingest = now
+
+    def start(self):
+        self.plugin.plugin_start(self.handle)
+        self.started = time.monotonic()
+
+    def publish(self, topic, payload):
+        """ Hands a message to the plugin like the paho network thread does on receipt
+
+        Args:
+            topic: topic as bytes
+            payload: payload bytes
+        """
+        msg = mqtt.MQTTMessage(topic=topic)
+        msg.payload = payload
+        msg.timestamp = self.last_publish = time.monotonic()
+        self.client.on_message(self.client.mqtt_client, None, msg)
+        self.published += 1
+
+    def stop(self):
+        """ Shuts the plugin down, which drains the queue and flushes the last batch """
+        self.plugin.plugin_shutdown(self.handle)
+
+    def results(self):
+        totals = self.client.metrics.totals()
+        decoded = sum(value for key, value in totals.items() if key.endswith('_messages'))
+        elapsed = max(self.last_ingest, self.last_publish) - self.started
+        ordered = sorted(self.latencies)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+        return {
+            'config': self.overrides,
+            'published': self.published,
+            'decoded': decoded,
+            'readings': len(ordered),
+            'seconds': elapsed,
+            'msgsPerSecond': decoded / elapsed if elapsed > 0 else 0.0,
+            'latency': {
+                'p50': percentile(ordered, 0.50),
+                'p99': percentile(ordered, 0.99),
+                'max': ordered[-1] if ordered else 0.0
+            },
+            'peakRssMB': peak_rss / 1024,
+            'queue': self.client.queue.stats(),
+            'totals': totals
+        }
+
+
+def print_results(result):
+    latency = result['latency']
+    print("published {}  decoded {}  ingested readings {}  in {:.2f}s".format(
+        result['published'], result['decoded'], result['readings'], result['seconds']))
+    print("{:.0f} msgs/s  latency p50 {:.3f} ms  p99 {:.3f} ms  max {:.3f} ms  peak RSS {:.1f} MB".format(
+        result['msgsPerSecond'], latency['p50'] * 1000, latency['p99'] * 1000, latency['max'] * 1000,
+        result['peakRssMB']))
+
+
+def run(args):
+    bench = OfflinePlugin(dict(item.split('=', 1) for item in args.set))
+    schemas = bench.client.schemas
+    stream_types = args.streams.split(',') if args.streams else schemas.stream_types
+    rng = random.Random(args.seed)
+    sources = []
+    for stream_type in stream_types:
+        if stream_type not in schemas:
+            raise SystemExit("No schema for stream type {}".format(stream_type))
+        schema = schemas.get(stream_type)
+        for device in range(args.devices):
+            topic = 'bench{}/{}'.format(device, stream_type).encode()
+            if args.records > 1:
+                # the plugin module put the plugin directory on sys.path
+                from mrb_envelope import pack_envelope
+
+                payloads = [pack_envelope(schema, random_payloads(schema, args.records, rng))
+                            for _ in range(_PAYLOAD_POOL)]
+            else:
+                payloads = random_payloads(schema, _PAYLOAD_POOL, rng)
+            sources.append((topic, payloads))
+
+    total_rate = args.rate * len(stream_types)
+    bench.start()
+    start = bench.started
+    deadline = start + args.duration
+    published = 0
+    while True:
+        if args.count:
+            if published >= args.count:
+                break
+        elif published % 256 == 0 and time.monotonic() >= deadline:
+            break
+        if total_rate:
+            ahead = start + published / total_rate - time.monotonic()
+            if ahead > 0.001:
+                time.sleep(ahead)
+        topic, payloads = sources[published % len(sources)]
+        bench.publish(topic, payloads[(published // len(sources)) % _PAYLOAD_POOL])
+        published += 1
+    bench.stop()
+
+    result = bench.results()
+    result.update(streams=stream_types, devices=args.devices, rate=args.rate, records=args.records)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline throughput benchmark of the mqtt-readings-binary plugin')
+    parser.add_argument('--streams', default='', help='comma separated stream types, all schema files by default')
+    parser.add_argument('--devices', type=int, default=1, help='number of devices per stream type')
+    parser.add_argument('--rate', type=float, default=0, help='messages per second per stream type, 0 for max speed')
+    parser.add_argument('--records', type=int, default=1,
+                        help='records per message, more than 1 publishes envelopes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to publish for')
+    parser.add_argument('--count', type=int, default=0, help='number of messages to publish instead of a duration')
+    parser.add_argument('--set', action='append', default=[], metavar='ITEM=VALUE',
+                        help='override a plugin configuration item')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the random payloads')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    print("streams {}  devices {}  rate {}/s per stream  records per message {}  config {}".format(
+        ','.join(result['streams']), result['devices'], result['rate'] or 'max', result['records'],
+        result['config'] or 'defaults'))
+    print_results(result)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(result, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Capture of raw MQTT traffic and accelerated replay of it
+
+capture subscribes to a live broker and appends every message with its topic and receive time to a capture file.
+replay reads a capture file through a memory map and publishes its messages again, either to a broker or straight
+into MqttSubscriberClient.on_message of an offline mqtt-readings-binary plugin (see bench_mqtt_readings_binary.py),
+keeping the original spacing of the messages at 1x, speeding it up N times or sending as fast as possible.
+
+File layout, all integers little-endian:
+    header  magic (8 bytes), capture start time in seconds since the epoch (double)
+    record  record length (unsigned 32 bit), receive time in seconds after the capture start (double),
+            topic length (unsigned 16 bit), topic bytes, payload bytes
+
+Usage:
+    python3 benchmarks/mqtt_capture.py capture site.cap --host broker --topic '+/adstop' --topic '+/ddstop'
+    python3 benchmarks/mqtt_capture.py info site.cap
+    python3 benchmarks/mqtt_capture.py replay site.cap --host localhost --speed 10
+    python3 benchmarks/mqtt_capture.py replay site.cap --plugin --speed 0 --set batchDecode=true
+"""
+
+import argparse
+import datetime
+import mmap
+import signal
+import struct
+import sys
+import threading
+import time
+
+_MAGIC = b'MRBCAP01'
+_HEADER = struct.Struct('<8sd')
+_RECORD = struct.Struct('<IdH')
+
+
+class CaptureWriter(object):
+    """ Appends messages to a new capture file
+
+    Args:
+        path: path of the capture file, an existing file is replaced
+    """
+
+    __slots__ = ['path', 'count', '_file', '_start', '_lock']
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'wb', buffering=1024 * 1024)
+        self._start = time.monotonic()
+        self._file.write(_HEADER.pack(_MAGIC, time.time()))
+        self._lock = threading.Lock()
+
+    def append(self, topic, payload, received):
+        """ Appends a message
+
+        Args:
+            topic: topic as bytes
+            payload: payload bytes
+            received: receive time in seconds of the monotonic clock
+        """
+        with self._lock:
+            self._file.write(_RECORD.pack(_RECORD.size + len(topic) + len(payload), received - self._start,
+                                          len(topic)))
+            self._file.write(topic)
+            self._file.write(payload)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_capture(capture):
+    """ Yields (receive time after the capture start, topic bytes, payload bytes) of every message of a capture
+
+    Args:
+        capture: memory map or bytes of a capture file
+    """
+    magic, _ = _HEADER.unpack_from(capture, 0)
+    if magic != _MAGIC:
+        raise ValueError("Not a capture file")
+    offset = _HEADER.size
+    end = len(capture)
+    record_size = _RECORD.size
+    unpack_from = _RECORD.unpack_from
+    while offset + record_size <= end:
+        length, received, topic_length = unpack_from(capture, offset)
+        if offset + length > end:
+            # the capture was interrupted while the record was written
+            break
+        topic_end = offset + record_size + topic_length
+        yield received, capture[offset + record_size:topic_end], capture[topic_end:offset + length]
+        offset += length
+
+
+def _mqtt_client(args):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client()
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    client.connect(args.host, args.port)
+    return client
+
+
+def _capture(args):
+    writer = CaptureWriter(args.file)
+    client = _mqtt_client(args)
+    done = threading.Event()
+
+    def on_message(client, userdata, msg):
+        # paho stamps messages with the monotonic clock on receipt
+        writer.append(msg.topic.encode(), msg.payload, msg.timestamp)
+        if args.count and writer.count >= args.count:
+            done.set()
+
+    client.on_message = on_message
+    client.subscribe([(topic, args.qos) for topic in args.topic])
+    signal.signal(signal.SIGINT, lambda *_: done.set())
+    signal.signal(signal.SIGTERM, lambda *_: done.set())
+    client.loop_start()
+    done.wait(args.duration or None)
+    client.disconnect()
+    client.loop_stop()
+    writer.close()
+    print("{} messages captured to {}".format(writer.count, args.file))
+
+
+def _info(args):
+    with open(args.file, 'rb') as capture_file:
+        with mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+            _, started = _HEADER.unpack_from(capture, 0)
+            count = 0
+            payload_bytes = 0
+            last = 0.0
+            topics = {}
+            for received, topic, payload in read_capture(capture):
+                count += 1
+                payload_bytes += len(payload)
+                last = received
+                topics[topic] = topics.get(topic, 0) + 1
+    print("captured {}  {} messages  {} payload bytes  {:.1f} seconds  {:.0f} msgs/s".format(
+        datetime.datetime.fromtimestamp(started).isoformat(sep=' '), count, payload_bytes, last,
+        count / last if last else 0))
+    for topic, topic_count in sorted(topics.items(), key=lambda item: -item[1])[:args.topics]:
+        print("  {}  {}".format(topic.decode(errors='replace'), topic_count))
+
+
+def _replay(args):
+    if args.plugin:
+        from bench_mqtt_readings_binary import OfflinePlugin, print_results
+
+        target = OfflinePlugin(dict(item.split('=', 1) for item in args.set))
+        target.start()
+        publish = target.publish
+    else:
+        client = _mqtt_client(args)
+        client.loop_start()
+        last = [None]
+
+        def publish(topic, payload):
+            last[0] = client.publish(topic.decode(), payload, qos=args.qos)
+
+    count = 0
+    with open(args.file, 'rb') as capture_file:
+        with mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ) as capture:
+            for _ in range(args.loop):
+                start = time.monotonic()
+                first = None
+                for received, topic, payload in read_capture(capture):
+                    if args.speed:
+                        if first is None:
+                            first = received
+                        ahead = start + (received - first) / args.speed - time.monotonic()
+                        if ahead > 0.001:
+                            time.sleep(ahead)
+                    publish(topic, payload)
+                    count += 1
+
+    if args.plugin:
+        target.stop()
+        print_results(target.results())
+    else:
+        if last[0] is not None:
+            last[0].wait_for_publish()
+        client.disconnect()
+        client.loop_stop()
+        print("{} messages replayed to {}:{}".format(count, args.host, args.port))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Capture raw MQTT traffic and replay it at 1x, Nx or max speed')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    def broker_arguments(command_parser):
+        command_parser.add_argument('--host', default='localhost')
+        command_parser.add_argument('--port', type=int, default=1883)
+        command_parser.add_argument('--username')
+        command_parser.add_argument('--password')
+        command_parser.add_argument('--qos', type=int, default=0, choices=(0, 1, 2))
+
+    capture_parser = commands.add_parser('capture', help='record the messages of a live broker')
+    capture_parser.add_argument('file')
+    broker_arguments(capture_parser)
+    capture_parser.add_argument('--topic', action='append', default=[], help='topic filter, # by default')
+    capture_parser.add_argument('--duration', type=float, default=0, help='seconds to capture for, 0 until Ctrl-C')
+    capture_parser.add_argument('--count', type=int, default=0, help='number of messages to capture, 0 no limit')
+    capture_parser.set_defaults(func=_capture)
+
+    info_parser = commands.add_parser('info', help='summarise a capture file')
+    info_parser.add_argument('file')
+    info_parser.add_argument('--topics', type=int, default=10, help='number of busiest topics to list')
+    info_parser.set_defaults(func=_info)
+
+    replay_parser = commands.add_parser('replay', help='publish the messages of a capture file again')
+    replay_parser.add_argument('file')
+    broker_arguments(replay_parser)
+    replay_parser.add_argument('--speed', type=float, default=1, help='speed up factor, 0 for max speed')
+    replay_parser.add_argument('--loop', type=int, default=1, help='number of times to replay the capture')
+    replay_parser.add_argument('--plugin', action='store_true',
+                               help='replay into an offline mqtt-readings-binary plugin instead of a broker')
+    replay_parser.add_argument('--set', action='append', default=[], metavar='ITEM=VALUE',
+                               help='override a plugin configuration item of --plugin')
+    replay_parser.set_defaults(func=_replay)
+
+    args = parser.parse_args(argv)
+    if args.command == 'capture' and not args.topic:
+        args.topic = ['#']
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Stand-in for the async_ingest module of the Fledge south service
+
+Readings handed to ingest_callback are passed to the sink set by the benchmark instead of the storage layer.
+"""
+
+sink = None
+
+
+async def ingest_callback(callback, ingest_ref, data):
+    if sink is not None:
+        sink(data if isinstance(data, list) else [data])
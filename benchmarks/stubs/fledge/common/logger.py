@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Stand-in for fledge.common.logger, logs to stderr instead of syslog """
+
+import logging
+
+SYSLOG = 0
+CONSOLE = 1
+
+
+def setup(logger_name=None, destination=SYSLOG, level=logging.WARNING, propagate=False):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(level)
+    return logger
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Stand-in for fledge.plugins.common.utils """
+
+import datetime
+
+
+def local_timestamp():
+    """ Returns the current time as a Fledge reading timestamp string """
+    return str(datetime.datetime.now(datetime.timezone.utc).astimezone())
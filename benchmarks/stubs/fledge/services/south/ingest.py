@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Stand-in for fledge.services.south.ingest """
+
+
+class Ingest(object):
+    pass
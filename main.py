@@ -549,6 +549,32 @@ async def create_multiple_services(
     
     return {"created_devices": created_devices}
 
+# Endpoint to create one wildcard service ingesting every device of a site
+@app.post("/comm_gw/fledge/services/fleet", tags=["Creating Bulk Services"], summary="Create One Service For All Devices")
+async def create_fleet_service(
+    service_name: str = "fleet",
+    topics: str = "+/pdstop,+/adstop,+/pqstop,+/ddstop",
+    asset_template: str = "{device}_{stream}_Feeder"
+):
+    payload = ServicePayload(
+        name=service_name,
+        type="south",
+        plugin="mqtt-readings-binary",
+        config=Config(
+            brokerHost=BrokerHostConfig(value="mosquitto"),
+            topic=TopicConfig(value=topics),
+            assetName=AssetNameConfig(value=asset_template)
+        ),
+        enabled=True
+    )
+
+    url = f"{FLEDGE_BASE_URL}/fledge/service"
+    response = requests.post(url, json=payload.dict())
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"Error creating service {service_name}: {response.text}")
+
+    return response.json()
+
 #Stopping and Starting Services¶
 @app.put("/comm_gw/fledge/schedule/disable", tags=["Stopping and Starting Services"], summary="Stop a Service")
 async def stop_service(payload: dict = Body({"schedule_name": "Sine"})):
@@ -1,13 +1,55 @@
+import bisect
+import collections
+import fnmatch
 import json
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Global variables for configuration values
 config_values = {}
 
+# Channel plan compiled from ANALOG_CHANNELS and the factors, one
+# (input key, output key, scale, divisor, offset, is OLTC) tuple per configured channel
+channel_plan = ()
+
+# OLTC tap table compiled from OLTC_TAP_CONFIG, see compile_tap_table
+tap_table = ((), (), (), 0)
+
+# (channel plan, tap table) of the assets without a calibration profile
+default_profile = (channel_plan, tap_table)
+
+# Calibration profiles of the PROFILES configuration, one (asset name,
+# pattern, values) tuple per profile, and the profile index of every asset name
+profiles = ()
+profile_names = {}
+
+# Compiled (channel plan, tap table) of the recently used profiles keyed by
+# profile index, at most profile_cache_size of them
+profile_cache = collections.OrderedDict()
+profile_cache_size = 256
+
+# Profile index of every asset seen, -1 for the default profile. It is cleared
+# when more assets than MAX_ASSETS are seen
+asset_profiles = {}
+MAX_ASSETS = 100000
+
+# Smallest block of readings processed as NumPy columns, 0 disables the batch
+# mode. MIN_VECTOR_BLOCK in the configuration overrides it
+min_vector_block = 64
+
+# Trace log of the sampled reading traces, see mrb_latency_trace.py of the mqtt-readings-binary plugin
+trace_file = None
+
 def set_filter_config(configuration):
     """
     Reads the JSON configuration and stores the necessary values in global variables.
     """
-    global config_values
+    global config_values, channel_plan, tap_table, default_profile, min_vector_block, trace_file
+    global profiles, profile_names, profile_cache_size
     config = json.loads(configuration['config'])
     
     # Convert config to a flat dictionary for easier access
@@ -18,77 +60,303 @@ def set_filter_config(configuration):
     # Additional handling for OLTC_TAP_CONFIG since it's a list
     config_values['OLTC_TAP_CONFIG'] = [d for d in config['config'] if 'OLTC_TAP_CONFIG' in d][0]['OLTC_TAP_CONFIG']
 
+    channel_plan = compile_channel_plan(config_values)
+    tap_table = compile_tap_table(config_values['OLTC_TAP_CONFIG'], config_values.get("OLTC_SUB_FACTOR", 0))
+    default_profile = (channel_plan, tap_table)
+    min_vector_block = config.get('MIN_VECTOR_BLOCK', 64)
+
+    # Every profile is compiled once here to reject a broken one early
+    profiles = tuple(profile_values(config_values, profile) for profile in config.get('PROFILES', []))
+    profile_names = {}
+    for index, (asset, _, _) in enumerate(profiles):
+        if asset is not None:
+            profile_names.setdefault(asset, index)
+    profile_cache_size = max(1, config.get('PROFILE_CACHE_SIZE', 256))
+    profile_cache.clear()
+    asset_profiles.clear()
+    for index, (_, _, values) in enumerate(profiles):
+        compiled = compile_profile(values)
+        if index < profile_cache_size:
+            profile_cache[index] = compiled
+
+    # Optional JSON lines file the traces of the sampled readings are appended to
+    if trace_file is not None:
+        trace_file.close()
+        trace_file = None
+    if config.get('TRACE_FILE'):
+        trace_file = open(config['TRACE_FILE'], 'a', buffering=1)
+
     return True
 
-def find_tap_position(data, ana_ch, tapsubF):
+def compile_channel_plan(values):
+    """
+    Compiles the channel mapping and factors into a tuple of
+    (input key, output key, scale, divisor, offset, is OLTC) entries.
+
+    The factors of a channel become value * scale / divisor + offset. The
+    divide stays a separate step, folding it into the scale would change the
+    last bit of some results and with it their rounding. The divisor is None
+    for channels without one, so integer values stay integers as before.
+    Channels mapped to null are left out.
+    """
+    plan = []
+    for channel in values['ANALOG_CHANNELS']:
+        channel_key, channel_value = list(channel.items())[1]  # Get the key-value pair for the channel
+        if channel_value is None:
+            continue
+
+        normalized_value = channel_value.upper().replace(" ", "_")
+        if normalized_value == "OLTC":
+            plan.append((channel_key.encode(), b'TAP_POSITION', None, None, None, True))
+            continue
+
+        scale = values.get(f"{normalized_value}_MULT_FACTOR", 1)
+        divisor = values.get(f"{normalized_value}_DIV_FACTOR")
+        offset = -values.get(f"{normalized_value}_SUB_FACTOR", 0)
+        plan.append((channel_key.encode(), normalized_value.encode(), scale, divisor, offset, False))
+    return tuple(plan)
+
+def compile_tap_table(data, tapsubF):
     """
-    Finds the tap position based on the measured value and tap configuration.
+    Compiles the tap configuration into (measured values in ascending order,
+    taps in the same order, table positions in the same order, sub factor).
+
+    A tap matches a value when its measured value lies within (value - sub
+    factor, value + sub factor]. When the ranges of neighbouring taps overlap,
+    which they do in the shipped configuration, the tap listed first in the
+    table wins as before, so the table positions are kept with the sorted
+    measured values.
+
+    Raises ValueError for entries without a numeric Tap and Measured Value.
     """
-    for entry in data:
-        tap_measured_value = entry["Measured Value"]
-        
-        # Calculate the lower and upper bounds
-        lower_bound = ana_ch - tapsubF
-        upper_bound = ana_ch + tapsubF
-        
-        # Check if the measured value falls within the range
-        if lower_bound < tap_measured_value <= upper_bound:
-            return entry["Tap"]
-        
-    return 0  # Return 0 if no tap position matches
+    entries = []
+    for position, entry in enumerate(data):
+        if not isinstance(entry, dict) or "Tap" not in entry or "Measured Value" not in entry:
+            raise ValueError(f"OLTC_TAP_CONFIG entry {position} needs a Tap and a Measured Value")
+        measured = entry["Measured Value"]
+        if isinstance(measured, bool) or not isinstance(measured, (int, float)) or measured != measured:
+            raise ValueError(f"OLTC_TAP_CONFIG entry {position} has a measured value {measured!r} that is not a number")
+        entries.append((measured, position, entry["Tap"]))
+    entries.sort()
+    return (tuple(entry[0] for entry in entries), tuple(entry[2] for entry in entries),
+            tuple(entry[1] for entry in entries), tapsubF)
 
-def doit(reading):
+def profile_values(defaults, profile):
     """
-    Processes the reading using the global configuration values.
+    Returns (asset name, pattern, values) of a calibration profile.
+
+    A profile names an exact "asset" or an fnmatch "pattern" such as
+    "*_adstop_Feeder" and holds its own ANALOG_CHANNELS and "config" factors,
+    both optional, the defaults of the filter fill in what it leaves out.
     """
-    global config_values
-    
-    # Example channel mapping (ANALOG_CHANNELS from configuration)
-    analog_channels = config_values['ANALOG_CHANNELS']
+    if not isinstance(profile, dict) or ('asset' in profile) == ('pattern' in profile):
+        raise ValueError(f"Calibration profile {profile!r} needs either an asset or a pattern")
+    values = dict(defaults)
+    values.update({k: v for d in profile.get('config', []) for k, v in d.items()})
+    if 'ANALOG_CHANNELS' in profile:
+        values['ANALOG_CHANNELS'] = profile['ANALOG_CHANNELS']
+    return profile.get('asset'), profile.get('pattern'), values
 
-    for channel in analog_channels:
-        channel_key, channel_value = list(channel.items())[1]  # Get the key-value pair for the channel
-        reading_key = channel_key.encode()  # Encoding string to bytes for matching reading keys
-        
-        if reading_key in reading:
-             # Skip processing if the channel_value is None
-            if channel_value is None:
-                continue
-
-            # Normalize the channel value
-            normalized_value = channel_value.upper().replace(" ", "_")
-            
-            # Construct the keys for factors
-            mult_key = f"{normalized_value}_MULT_FACTOR"
-            div_key = f"{normalized_value}_DIV_FACTOR"
-            sub_key = f"{normalized_value}_SUB_FACTOR"
-            
-            result = reading[reading_key]
-
-            # Apply multiplier factor if it exists
-            if mult_key in config_values:
-                result *= config_values[mult_key]
-            
-            # Apply division factor if it exists
-            if div_key in config_values:
-                result /= config_values[div_key]
-            
-            # Apply subtraction factor if it exists
-            if sub_key in config_values:
-                result -= config_values[sub_key]
-            
-            # Special handling for OLTC: find and store the tap position
-            if normalized_value == "OLTC":
-                tap_position = find_tap_position(config_values['OLTC_TAP_CONFIG'], reading[reading_key], config_values.get("OLTC_SUB_FACTOR", 0))
-                reading[b'TAP_POSITION'] = tap_position
-            else:
-                # Store the calculated result back in the reading
-                reading[normalized_value.encode()] = round(result,2)
+def compile_profile(values):
+    """
+    Compiles the values of a profile into (channel plan, tap table).
+    """
+    return (compile_channel_plan(values),
+            compile_tap_table(values['OLTC_TAP_CONFIG'], values.get("OLTC_SUB_FACTOR", 0)))
+
+def profile_for(asset):
+    """
+    Returns the compiled (channel plan, tap table) of an asset.
+
+    The asset name is matched once against the exact names and then the
+    patterns in configuration order, later readings of the asset only cost a
+    dictionary lookup and the LRU update of its profile.
+    """
+    index = asset_profiles.get(asset)
+    if index is None:
+        name = asset.decode() if isinstance(asset, bytes) else asset
+        index = profile_names.get(name, -1)
+        if index < 0 and name is not None:
+            for position, (_, pattern, _) in enumerate(profiles):
+                if pattern is not None and fnmatch.fnmatchcase(name, pattern):
+                    index = position
+                    break
+        if len(asset_profiles) >= MAX_ASSETS:
+            asset_profiles.clear()
+        asset_profiles[asset] = index
+    if index < 0:
+        return default_profile
+
+    compiled = profile_cache.get(index)
+    if compiled is None:
+        compiled = profile_cache[index] = compile_profile(profiles[index][2])
+        if len(profile_cache) > profile_cache_size:
+            profile_cache.popitem(last=False)
+    else:
+        profile_cache.move_to_end(index)
+    return compiled
+
+def find_tap_position(table, ana_ch):
+    """
+    Finds the tap position of a measured value in the compiled tap table.
+    """
+    measured, taps, positions, tapsubF = table
+
+    # The taps whose measured value falls within the range
+    first = bisect.bisect_right(measured, ana_ch - tapsubF)
+    end = bisect.bisect_right(measured, ana_ch + tapsubF)
+    if end - first == 1:
+        return taps[first]
+    if end <= first:
+        return 0  # Return 0 if no tap position matches
+
+    # Overlapping ranges, the tap listed first in the table wins
+    best = min(range(first, end), key=positions.__getitem__)
+    return taps[best]
+
+def doit(reading, profile=None):
+    """
+    Processes the reading using the compiled channel plan of a profile, the
+    default channel plan when no profile is given.
+    """
+    plan, table = profile if profile is not None else default_profile
+    for input_key, output_key, scale, divisor, offset, oltc in plan:
+        value = reading.get(input_key)
+        if value is None:
+            continue
+
+        # Special handling for OLTC: find and store the tap position
+        if oltc:
+            reading[output_key] = find_tap_position(table, value)
+        else:
+            result = value * scale
+            if divisor is not None:
+                result /= divisor
+
+            # Store the calculated result back in the reading
+            reading[output_key] = round(result + offset, 2)
+
+def trace(reading):
+    """
+    Adds the filter stage to the trace datapoint of a sampled reading and writes the trace to the trace file.
+    """
+    record = json.loads(reading[b'trace'])
+    record['filtered'] = time.time()
+    reading[b'trace'] = json.dumps(record)
+    if trace_file is not None:
+        trace_file.write(reading[b'trace'] + '\n')
+
+def find_tap_positions(table, values):
+    """
+    Vectorized find_tap_position over an array of measured values.
+    """
+    measured, taps, positions, tapsubF = table
+    if not measured:
+        return [0] * len(values)
+    measured = np.array(measured, dtype=np.float64)
+    first = np.searchsorted(measured, values - tapsubF, side='right')
+    count = np.searchsorted(measured, values + tapsubF, side='right') - first
+
+    # Overlapping ranges, the tap listed first in the table wins
+    positions = np.array(positions)
+    best = np.minimum(first, len(positions) - 1)
+    for step in range(1, int(count.max(initial=0))):
+        candidate = np.minimum(first + step, len(positions) - 1)
+        better = (step < count) & (positions[candidate] < positions[best])
+        best[better] = candidate[better]
+
+    # The taps keep their configured type
+    result = np.array(taps + (0,), dtype=object)[np.where(count > 0, best, len(taps))]
+    return result.tolist()
+
+def round_column(values):
+    """
+    Rounds an array to 2 decimals like round() does.
+
+    np.round scales by 100 and rounds to even, which only disagrees with the
+    correctly rounded round() at ties after scaling, those few values are
+    rounded by round().
+    """
+    rounded = np.round(values, 2)
+    scaled = values * 100
+    distance = np.abs(scaled - np.floor(scaled) - 0.5)
+    ties = np.flatnonzero(distance <= 1e-15 * np.maximum(1.0, np.abs(scaled)))
+    for index in ties.tolist():
+        rounded[index] = round(float(values[index]), 2)
+    return rounded
+
+def calculate_block(block, profile=None):
+    """
+    Processes a block of readings column by column with NumPy, using the
+    compiled channel plan of a profile or the default one.
+
+    Channels whose results are floats, i.e. with a divisor or a float factor,
+    are computed as float64 columns with the same operations as doit, the
+    other channels keep the per reading arithmetic so integers stay integers.
+    """
+    plan, table = profile if profile is not None else default_profile
+    for input_key, output_key, scale, divisor, offset, oltc in plan:
+        rows = []
+        values = []
+        for reading in block:
+            value = reading.get(input_key)
+            if value is not None:
+                rows.append(reading)
+                values.append(value)
+        if not rows:
+            continue
+
+        if oltc:
+            results = find_tap_positions(table, np.array(values, dtype=np.float64))
+        elif divisor is not None or isinstance(scale, float) or isinstance(offset, float):
+            column = np.array(values, dtype=np.float64) * scale
+            if divisor is not None:
+                column /= divisor
+            results = round_column(column + offset).tolist()
+        else:
+            results = [round(value * scale + offset, 2) for value in values]
+
+        for reading, result in zip(rows, results):
+            reading[output_key] = result
+
+def calculate_profiles(readings):
+    """
+    Processes readings with the calibration profile of their asset.
+    """
+    vectorize = np is not None and min_vector_block and len(readings) >= min_vector_block
+    if not vectorize:
+        for elem in readings:
+            doit(elem['reading'], profile_for(elem.get('asset_code')))
+        return
+
+    # Readings of the same profile are processed as one block
+    blocks = {}
+    for elem in readings:
+        profile = profile_for(elem.get('asset_code'))
+        block = blocks.get(id(profile))
+        if block is None:
+            block = blocks[id(profile)] = (profile, [])
+        block[1].append(elem['reading'])
+    for profile, block in blocks.values():
+        if len(block) >= min_vector_block:
+            calculate_block(block, profile)
+        else:
+            for reading in block:
+                doit(reading, profile)
 
 # process one or more readings
 def calculate_ads_values(readings):
-    for elem in list(readings):
-        doit(elem['reading'])
+    if profiles:
+        calculate_profiles(readings)
+    elif np is not None and min_vector_block and len(readings) >= min_vector_block:
+        calculate_block([elem['reading'] for elem in readings])
+    else:
+        for elem in readings:
+            doit(elem['reading'])
+
+    for elem in readings:
+        if b'trace' in elem['reading']:
+            trace(elem['reading'])
     return readings
 
 # Main entry point for testing
@@ -151,7 +419,7 @@ if __name__ == "__main__":
     
     
     # Load the configuration
-    set_filter_config(config_json)
-    # Process the reading
-    updated_reading = doit(reading)
-    print(updated_reading)
+    set_filter_config({'config': config_json})
+    # Process the reading, doit updates it in place
+    doit(reading)
+    print(reading)
@@ -0,0 +1,316 @@
+import calendar
+import datetime
+import json
+import time
+
+# Global variables for configuration values
+config_values = {}
+
+# Datapoints whose name starts with one of these prefixes are cumulative counters
+counter_prefixes = ('ActiveEnergy', 'ReactiveEnergy', 'ApparentEnergy')
+
+# Suffixes of the datapoints derived from a counter, they are not counters themselves
+DERIVED_SUFFIXES = ('_Delta', '_Demand', '_Reset')
+
+# Modulus of counters that wrap around, e.g. 4294967296 for 32 bit counters, 0 when
+# they do not wrap and every decrease is a reset
+counter_rollover = 0
+
+# Rolling demand window in seconds and the number of buckets it is kept in, 0 disables the demand
+demand_window = 900
+demand_buckets = 15
+
+# Phase groups of the imbalance by name, PHASE_GROUPS in the configuration overrides them
+DEFAULT_PHASE_GROUPS = {
+    'AvgVtg': ['AvgVtg_R', 'AvgVtg_Y', 'AvgVtg_B'],
+    'AvgCur': ['AvgCur_R', 'AvgCur_Y', 'AvgCur_B'],
+    'ActivePower': ['ActivePower_R', 'ActivePower_Y', 'ActivePower_B']
+}
+
+# Phase groups of the imbalance, (output name, (phase R, phase Y, phase B)) tuples
+phase_groups = tuple((name + '_Imbalance', tuple(phases)) for name, phases in DEFAULT_PHASE_GROUPS.items())
+
+# Plan of every key set seen, see compile_plan, cleared when more than MAX_KEY_SETS are seen
+plans = {}
+MAX_KEY_SETS = 4096
+
+# State of every device keyed by asset code, cleared when more than MAX_DEVICES are seen
+devices = {}
+MAX_DEVICES = 100000
+
+# Midnight in seconds since the epoch of the dates of the reading timestamps
+midnights = {}
+MAX_DAYS = 1024
+
+class DemandWindow(object):
+    """
+    Rolling sum of the counter deltas of the last demand window.
+
+    The window is kept as a ring of bucket sums, so adding a delta and reading
+    the sum cost the same however many readings the window holds. A bucket is
+    emptied when the window moves past it, so the window slides in steps of
+    one bucket.
+
+    A delta is the increase since the previous reading and lands in the
+    bucket of its reading, so every bucket also keeps the start of its oldest
+    delta: the sum covers the time from the start of the oldest delta still in
+    the window to the last reading.
+    """
+
+    __slots__ = ['sums', 'starts', 'total', 'bucket']
+
+    def __init__(self, bucket):
+        self.sums = [0.0] * demand_buckets
+        self.starts = [None] * demand_buckets
+        self.total = 0.0
+        self.bucket = bucket
+
+    def add(self, bucket, delta, start):
+        """
+        Adds the delta of a reading in a bucket, start is the time of the
+        previous reading the delta counts from.
+        """
+        if bucket > self.bucket:
+            # at most one pass over the ring, a long gap empties it
+            for index in range(self.bucket + 1, min(bucket, self.bucket + demand_buckets) + 1):
+                slot = index % demand_buckets
+                self.total -= self.sums[slot]
+                self.sums[slot] = 0.0
+                self.starts[slot] = None
+            self.bucket = bucket
+            if not any(self.sums):
+                # no rounding drift of the running total survives an empty window
+                self.total = 0.0
+        slot = bucket % demand_buckets
+        self.sums[slot] += delta
+        if self.starts[slot] is None:
+            self.starts[slot] = start
+        self.total += delta
+
+    def start(self):
+        """
+        Returns the start of the oldest delta in the window.
+        """
+        for index in range(self.bucket + 1, self.bucket + demand_buckets + 1):
+            start = self.starts[index % demand_buckets]
+            if start is not None:
+                return start
+
+class DeviceState(object):
+    """
+    Derived metrics state of one device: the plan of its readings, the time of
+    its last reading, the last (value, time) of every counter and the demand
+    window of every counter.
+    """
+
+    __slots__ = ['width', 'plan', 'time', 'counters', 'windows']
+
+    def __init__(self):
+        self.width = -1
+        self.plan = None
+        self.time = None
+        self.counters = {}
+        self.windows = {}
+
+def set_filter_config(configuration):
+    """
+    Reads the JSON configuration and stores the necessary values in global variables.
+    """
+    global config_values, counter_prefixes, counter_rollover, demand_window, demand_buckets, phase_groups
+    config_values = json.loads(configuration['config'])
+
+    counter_prefixes = tuple(config_values.get('COUNTER_PREFIXES', counter_prefixes))
+    counter_rollover = config_values.get('COUNTER_ROLLOVER', 0)
+    demand_window = config_values.get('DEMAND_WINDOW', 900)
+    demand_buckets = max(1, config_values.get('DEMAND_BUCKETS', 15))
+    groups = []
+    for name, phases in config_values.get('PHASE_GROUPS', DEFAULT_PHASE_GROUPS).items():
+        if len(phases) != 3:
+            raise ValueError(f"Phase group {name} needs the datapoints of three phases, not {phases!r}")
+        groups.append((name + '_Imbalance', tuple(phases)))
+    phase_groups = tuple(groups)
+
+    # The state of the devices depends on the configuration
+    plans.clear()
+    devices.clear()
+    return True
+
+def compile_plan(keys):
+    """
+    Compiles the datapoint names of a reading into (counters, phase groups).
+
+    Counters are (key, delta key, demand key, reset key) entries, phase groups
+    (imbalance key, phase keys) entries of the groups whose three phases are
+    all in the reading. The keys have the type of the reading keys, bytes or str.
+    """
+    encoded = bool(keys) and isinstance(keys[0], bytes)
+    names = {key.decode() if encoded else key: key for key in keys}
+
+    def key(name):
+        return name.encode() if encoded else name
+
+    counters = tuple((names[name], key(name + '_Delta'), key(name + '_Demand'), key(name + '_Reset'))
+                     for name in names if name.startswith(counter_prefixes) and not name.endswith(DERIVED_SUFFIXES))
+    groups = tuple((key(output), tuple(names[phase] for phase in phases))
+                   for output, phases in phase_groups if all(phase in names for phase in phases))
+    return counters, groups
+
+def reading_time(elem):
+    """
+    Returns the time of a reading in seconds since the epoch.
+
+    The user timestamp of the reading, "YYYY-MM-DD HH:MM:SS[.ffffff][+HH:MM]",
+    is used when it has one and the current time otherwise. The midnight of
+    every date is only computed once.
+    """
+    timestamp = elem.get('user_ts') or elem.get('ts')
+    if not isinstance(timestamp, str) or len(timestamp) < 19:
+        return time.time()
+    day = timestamp[:10]
+    midnight = midnights.get(day)
+    if midnight is None:
+        if len(midnights) >= MAX_DAYS:
+            midnights.clear()
+        try:
+            midnight = calendar.timegm(datetime.datetime.strptime(day, '%Y-%m-%d').timetuple())
+        except ValueError:
+            midnight = False
+        midnights[day] = midnight
+    if midnight is False:
+        return time.time()
+
+    seconds = timestamp[17:]
+    offset = 0
+    if len(seconds) > 6 and seconds[-6] in '+-' and seconds[-3] == ':':
+        offset = int(seconds[-5:-3]) * 3600 + int(seconds[-2:]) * 60
+        if seconds[-6] == '-':
+            offset = -offset
+        seconds = seconds[:-6]
+    try:
+        return midnight + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 + float(seconds) - offset
+    except ValueError:
+        return time.time()
+
+def counter_delta(previous, value):
+    """
+    Returns (increase of a counter, True if the counter was reset).
+
+    A decrease is a wrap of the counter when COUNTER_ROLLOVER is set and the
+    counter dropped by more than half of it, any other decrease is a reset and
+    the new value is the increase since the reset.
+    """
+    delta = value - previous
+    if delta >= 0:
+        return delta, False
+    if counter_rollover and -delta > counter_rollover / 2:
+        return delta + counter_rollover, False
+    return value, True
+
+def doit(elem):
+    """
+    Adds the derived metrics of one reading and updates the state of its device.
+
+    The plan of a device is looked up again only when the number of datapoints
+    of its readings changes, the readings of a stream type carry the same
+    datapoints, so the work per reading does not grow with their number.
+    """
+    reading = elem['reading']
+    asset = elem.get('asset_code')
+    state = devices.get(asset)
+    if state is None:
+        if len(devices) >= MAX_DEVICES:
+            devices.clear()
+        state = devices[asset] = DeviceState()
+    if len(reading) != state.width:
+        keys = tuple(reading)
+        plan = plans.get(keys)
+        if plan is None:
+            if len(plans) >= MAX_KEY_SETS:
+                plans.clear()
+            plan = plans[keys] = compile_plan(keys)
+        state.width = len(reading)
+        state.plan = plan
+    counters, groups = state.plan
+
+    # Phase imbalance, the largest deviation from the average of the phases in percent of the average
+    for output_key, (phase_r, phase_y, phase_b) in groups:
+        r, y, b = reading.get(phase_r), reading.get(phase_y), reading.get(phase_b)
+        if r is None or y is None or b is None:
+            continue
+        average = (r + y + b) / 3
+        if average:
+            deviation = max(abs(r - average), abs(y - average), abs(b - average))
+            reading[output_key] = round(deviation / abs(average) * 100, 2)
+
+    if not counters:
+        return
+    now = reading_time(elem)
+    if state.time is not None and now < state.time:
+        # a reading older than the last one of the device, e.g. replayed, leaves the state alone
+        return
+    state.time = now
+    bucket = int(now * demand_buckets // demand_window) if demand_window else 0
+
+    for input_key, delta_key, demand_key, reset_key in counters:
+        value = reading.get(input_key)
+        if value is None:
+            continue
+        previous = state.counters.get(input_key)
+        state.counters[input_key] = (value, now)
+        if previous is None:
+            continue
+        delta, reset = counter_delta(previous[0], value)
+        reading[delta_key] = delta
+        if reset:
+            reading[reset_key] = 1
+
+        if demand_window:
+            window = state.windows.get(input_key)
+            if window is None:
+                window = state.windows[input_key] = DemandWindow(bucket)
+            window.add(bucket, delta, previous[1])
+            # counter units per hour over the buckets of the window, or over the time covered so far
+            span = now - window.start()
+            if span > 0:
+                reading[demand_key] = round(window.total * 3600 / span, 3)
+
+# process one or more readings
+def pqs_derived_metrics(readings):
+    for elem in readings:
+        doit(elem)
+    return readings
+
+# Main entry point for testing
+if __name__ == "__main__":
+
+    # Example configuration JSON
+    config_json = '''
+    {
+      "COUNTER_PREFIXES": ["ActiveEnergy", "ReactiveEnergy", "ApparentEnergy"],
+      "COUNTER_ROLLOVER": 0,
+      "DEMAND_WINDOW": 900,
+      "DEMAND_BUCKETS": 15,
+      "PHASE_GROUPS": {
+        "AvgVtg": ["AvgVtg_R", "AvgVtg_Y", "AvgVtg_B"],
+        "AvgCur": ["AvgCur_R", "AvgCur_Y", "AvgCur_B"]
+      }
+    }
+    '''
+
+    set_filter_config({'config': config_json})
+    for second, energy in ((0, 1000.0), (60, 1000.5), (120, 1001.25), (180, 0.25)):
+        elem = {
+            'asset_code': 'T1_pqstop_Feeder',
+            'user_ts': '2025-01-07 16:{:02d}:{:02d}.000000+00:00'.format(17 + second // 60, second % 60),
+            'reading': {
+                b'AvgVtg_R': 230.1,
+                b'AvgVtg_Y': 229.4,
+                b'AvgVtg_B': 226.8,
+                b'AvgCur_R': 10.2,
+                b'AvgCur_Y': 9.7,
+                b'AvgCur_B': 11.0,
+                b'ActiveEnergy_Import': energy
+            }
+        }
+        pqs_derived_metrics([elem])
+        print(elem['reading'])
@@ -3,20 +3,24 @@ import json
 # Define your data structure
 struct_format = (
                 '<'     # Little-endian specifier
-                '8B'    # 8 bytes for digital data (DigitalData)
+                '8B'    # 8 bytes for digital data (Digi1 .. Digi8)
                 'B B B B B B H'  # Timestamp components: seconds, minutes, hours, weekday, date, month, year
                 '?'     # Boolean for IsNlf
             )
 
 field_names = [
-    "DigitalData1", "DigitalData2", "DigitalData3", "DigitalData4",
-    "DigitalData5", "DigitalData6", "DigitalData7", "DigitalData8",
+    "Digi1", "Digi2", "Digi3", "Digi4",
+    "Digi5", "Digi6", "Digi7", "Digi8",
     "seconds", "minutes", "hours", "weekday", "date", "month", "year",
     "IsNlf"
 ]
 
 # Combine the format and field names into a dictionary
 data = {
+    "stream_type": "ddstop",  # topic suffix of the stream
+    "schema_id": 3,  # schema id and version in envelope headers
+    "version": 1,
+    "json_stream_type": "ddsdata",  # topic suffix of the JSON payloads of the stream
     "struct_format": struct_format,
     "field_names": field_names
 }
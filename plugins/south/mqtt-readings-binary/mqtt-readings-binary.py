@@ -6,10 +6,43 @@
 
 """ MQTT Subscriber 
 
-TODO:
+Report by exception
+    Stream types listed in reportByException, typically the ddstop digital states, are only ingested when one of
+    the data values of a device changes or the heartbeat interval expired since its last ingested reading.
+
+Compression
+    Stream types listed in deadbands are compressed per device with per field deadbands, either by deadband or by
+    swinging-door, see mrb_compression.py. The metrics report the compression ratio, received records per ingested
+    reading, of every stream type.
+
+Envelopes
+    A payload may frame several records of the stream type behind a header with the schema id, schema version and
+    record count, see mrb_envelope.py. The records are unpacked straight from the payload buffer.
+
+JSON payloads
+    Devices publishing JSON instead of packed records use the json_stream_type of the schema as topic suffix, e.g.
+    <device>/adsdata. The payloads are parsed with orjson when it is installed and their keys are checked against
+    the schema once per key set; DDS channel objects {"state": s, "timestamp": t} are flattened to their state, see
+    mrb_json_payload.py. A payload whose timestamp is not a string is a dead letter. Report by exception and
+    envelopes only apply to packed records.
+
+Store and forward
+    With a spill file configured, reading batches go to a memory-mapped ring file instead of Fledge while the last
+    ingest call took longer than spillLatency or spillQueueDepth messages queued up during it, see mrb_spill_buffer.py.
+    While the file holds readings new batches are appended behind them, and the file is drained in batches of
+    drainBatchSize once ingest keeps up again. The metrics report the spill and drain rates.
+
+Latency tracing
+    With latencyTracing enabled every reading is stamped on its way from the device RTC through the MQTT receive,
+    the end of decoding and the ingest call, see mrb_latency_trace.py. The metrics file holds per device lag
+    histograms of the stages and one in traceSampleInterval readings carries a "trace" datapoint with its stage
+    times, which is also written to the trace file. The calculate_ads_values filter adds its own stage to it.
+
+MQTT v5 and shared subscriptions
+    With a shared group configured every topic is subscribed as $share/<group>/<topic>, so several south services
+    in the same group split the messages of the topics between them instead of each receiving all of them.
 
-# MQTT v5 support using paho-mqtt v1.5.0 
-    https://github.com/eclipse/paho.mqtt.python/blob/master/ChangeLog.txt
+TODO:
 
 # broker bind_address
     The IP address of a local network interface to bind this client to, assuming multiple interfaces exist
@@ -51,19 +84,45 @@ TODO:
 
 import asyncio
 import copy
-import json
+import datetime
+import hashlib
 import logging
+import os
+import random
+import socket
+import sys
+import threading
+import time
 import uuid
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 from fledge.common import logger
 from fledge.plugins.common import utils
 from fledge.services.south import exceptions
 from fledge.services.south.ingest import Ingest
 import async_ingest
-import struct
-import json
+
+# the helper modules carry the mrb_ prefix, so neither the standard library, e.g. the compression package of Python
+# 3.14, nor another plugin shadows them on the shared sys.path
+_PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+if _PLUGIN_DIR not in sys.path:
+    sys.path.append(_PLUGIN_DIR)
+
+from mrb_compression import Compressor, parse_deadbands
+from mrb_dead_letter import DeadLetterStore
+from mrb_envelope import HEADER as ENVELOPE_HEADER, is_envelope, iter_records
+from mrb_ingest_batcher import ReadingBatcher
+from mrb_ingest_metrics import IngestMetrics, write_snapshot
+from mrb_ingest_queue import BoundedQueue, POLICIES
+from mrb_json_payload import JsonDecoder
+from mrb_latency_trace import LatencyTracer
+from mrb_report_by_exception import ReportByException
+from mrb_rtc_time import RtcClock
+from mrb_schema_registry import SchemaRegistry
+from mrb_spill_buffer import SpillBuffer
 
 __author__ = "Praveen Garg"
 __copyright__ = "Copyright (c) 2020 Dianomic Systems, Inc."
@@ -76,6 +135,24 @@ c_callback = None
 c_ingest_ref = None
 loop = None
 
+# Smallest group of same-schema messages worth decoding in one go, smaller groups are decoded one by one
+_MIN_BATCH_DECODE = 8
+
+# Minimum number of seconds between two warnings about messages dropped by the ingest queue
+_DROP_REPORT_INTERVAL = 10
+
+# Upper bound of the topic to route cache, it is cleared when a wildcard subscription sees more distinct topics
+_MAX_ROUTES = 100000
+
+# Number of seconds between two drain attempts while Fledge ingest is too slow
+_SPILL_PROBE_INTERVAL = 5
+
+# MQTT v5 session expiry interval of a session that does not expire, the MQTT 3.1.1 persistent session
+_SESSION_NEVER_EXPIRES = 0xFFFFFFFF
+
+# Number of seconds stop waits for the network thread before it closes the broker socket under it
+_STOP_TIMEOUT = 5
+
 _DEFAULT_CONFIG = {
     'plugin': {
         'description': 'MQTT Subscriber South Plugin',
@@ -108,7 +185,8 @@ _DEFAULT_CONFIG = {
         'displayName': 'Keep Alive Interval'
     },
     'topic': {
-        'description': 'The subscription topic to subscribe to receive messages',
+        'description': 'The subscription topic to subscribe to receive messages. A comma separated list of topics '
+                       'is accepted and topics may use the MQTT wildcards + and #, e.g. +/adstop, +/adsdata or +/+',
         'type': 'string',
         'default': 'Room1/conditions',
         'order': '4',
@@ -125,12 +203,299 @@ _DEFAULT_CONFIG = {
         'maximum': '2'
     },
     'assetName': {
-        'description': 'Name of Asset',
+        'description': 'Name of Asset. {device} and {stream} are replaced by the device id and the stream type '
+                       'taken from the last two levels of the message topic, e.g. {device}_{stream}_Feeder',
         'type': 'string',
         'default': 'mqtt-',
         'order': '6',
         'displayName': 'Asset Name',
         'mandatory': 'true'
+    },
+    'schemaCheckInterval': {
+        'description': 'Minimum number of seconds between two checks of the schema files for changes',
+        'type': 'integer',
+        'default': '10',
+        'order': '7',
+        'displayName': 'Schema Check Interval',
+        'minimum': '1'
+    },
+    'ingestBatchSize': {
+        'description': 'Number of readings collected before they are sent to Fledge in one ingest call',
+        'type': 'integer',
+        'default': '100',
+        'order': '8',
+        'displayName': 'Ingest Batch Size',
+        'minimum': '1'
+    },
+    'ingestBatchAge': {
+        'description': 'Maximum time in milliseconds a reading waits in the ingest batch before the batch is sent',
+        'type': 'integer',
+        'default': '500',
+        'order': '9',
+        'displayName': 'Ingest Batch Age (ms)',
+        'minimum': '1'
+    },
+    'ingestQueueSize': {
+        'description': 'Maximum number of received messages waiting for decoding and ingest',
+        'type': 'integer',
+        'default': '10000',
+        'order': '10',
+        'displayName': 'Ingest Queue Size',
+        'minimum': '1'
+    },
+    'ingestQueuePolicy': {
+        'description': 'What to do with a received message when the ingest queue is full: block the MQTT network '
+                       'thread, drop the oldest queued message or drop the new message',
+        'type': 'enumeration',
+        'options': list(POLICIES),
+        'default': 'block',
+        'order': '11',
+        'displayName': 'Ingest Queue Overflow Policy'
+    },
+    'batchDecode': {
+        'description': 'Decode the queued messages of the same stream type together in one pass',
+        'type': 'boolean',
+        'default': 'false',
+        'order': '12',
+        'displayName': 'Batch Decode'
+    },
+    'timestampSource': {
+        'description': 'Timestamp of the readings, the time the message was received or the device RTC time '
+                       'carried in the message',
+        'type': 'enumeration',
+        'options': ['receive', 'device'],
+        'default': 'receive',
+        'order': '13',
+        'displayName': 'Timestamp Source'
+    },
+    'deviceTimezone': {
+        'description': 'UTC offset of the device RTC time, e.g. +05:30',
+        'type': 'string',
+        'default': '+00:00',
+        'order': '14',
+        'displayName': 'Device Timezone'
+    },
+    'timestampDatapoint': {
+        'description': 'Add the device RTC time as a timestamp datapoint to every reading',
+        'type': 'boolean',
+        'default': 'true',
+        'order': '15',
+        'displayName': 'Timestamp Datapoint'
+    },
+    'payloadLogInterval': {
+        'description': 'Minimum number of seconds between two received payloads written to the log, 0 disables '
+                       'payload logging',
+        'type': 'integer',
+        'default': '60',
+        'order': '16',
+        'displayName': 'Payload Log Interval',
+        'minimum': '0'
+    },
+    'metricsInterval': {
+        'description': 'Number of seconds between two reports of the ingest metrics',
+        'type': 'integer',
+        'default': '60',
+        'order': '17',
+        'displayName': 'Metrics Interval',
+        'minimum': '1'
+    },
+    'metricsFile': {
+        'description': 'Path of a JSON file the ingest metrics per stream type and device are written to, '
+                       'leave empty to not write a metrics file',
+        'type': 'string',
+        'default': '',
+        'order': '18',
+        'displayName': 'Metrics File'
+    },
+    'metricsAsset': {
+        'description': 'Name of an asset the ingest metrics totals per stream type are ingested as, '
+                       'leave empty to not ingest metrics',
+        'type': 'string',
+        'default': '',
+        'order': '19',
+        'displayName': 'Metrics Asset'
+    },
+    'deadLetterFile': {
+        'description': 'Path of the file undecodable payloads are stored in. Only a small counter reading is '
+                       'ingested for them. Leave empty to ingest undecodable payloads as a list of bytes',
+        'type': 'string',
+        'default': '',
+        'order': '20',
+        'displayName': 'Dead Letter File'
+    },
+    'deadLetterFileSize': {
+        'description': 'Size in megabytes of a new dead letter file, dead letters are dropped once it is full',
+        'type': 'integer',
+        'default': '16',
+        'order': '21',
+        'displayName': 'Dead Letter File Size (MB)',
+        'minimum': '1'
+    },
+    'protocol': {
+        'description': 'MQTT protocol version used to connect to the broker',
+        'type': 'enumeration',
+        'options': ['MQTTv311', 'MQTTv5'],
+        'default': 'MQTTv311',
+        'order': '22',
+        'displayName': 'MQTT Protocol'
+    },
+    'sharedGroup': {
+        'description': 'Shared subscription group. Services in the same group share the messages of the topics '
+                       'through the broker instead of each receiving every message. Leave empty to not share',
+        'type': 'string',
+        'default': '',
+        'order': '23',
+        'displayName': 'Shared Subscription Group'
+    },
+    'receiveMaximum': {
+        'description': 'Maximum number of unacknowledged QoS 1 and 2 messages the broker sends at once, '
+                       '0 keeps the broker default. MQTT v5 only',
+        'type': 'integer',
+        'default': '0',
+        'order': '24',
+        'displayName': 'Receive Maximum',
+        'minimum': '0',
+        'maximum': '65535'
+    },
+    'sessionExpiryInterval': {
+        'description': 'Number of seconds the broker keeps the session after a disconnect, 0 keeps a persistent '
+                       'session without expiry. MQTT v5 only',
+        'type': 'integer',
+        'default': '0',
+        'order': '25',
+        'displayName': 'Session Expiry Interval',
+        'minimum': '0'
+    },
+    'clientId': {
+        'description': 'MQTT client id. Leave empty to derive a stable id from the broker, topics, asset name, host '
+                       'and service name. Services sharing a subscription group need distinct ids',
+        'type': 'string',
+        'default': '',
+        'order': '26',
+        'displayName': 'Client Id'
+    },
+    'persistentSession': {
+        'description': 'Keep the session on the broker across reconnects and restarts, so QoS 1 and 2 messages '
+                       'published while disconnected are delivered. With MQTT v5 the broker keeps the session for '
+                       'the session expiry interval, or without expiry when it is 0',
+        'type': 'boolean',
+        'default': 'true',
+        'order': '27',
+        'displayName': 'Persistent Session'
+    },
+    'reconnectMinDelay': {
+        'description': 'Number of seconds to wait before the first reconnect attempt, doubled on every failed attempt',
+        'type': 'integer',
+        'default': '1',
+        'order': '28',
+        'displayName': 'Reconnect Min Delay',
+        'minimum': '1'
+    },
+    'reconnectMaxDelay': {
+        'description': 'Maximum number of seconds to wait between two reconnect attempts',
+        'type': 'integer',
+        'default': '120',
+        'order': '29',
+        'displayName': 'Reconnect Max Delay',
+        'minimum': '1'
+    },
+    'reportByException': {
+        'description': 'Comma separated stream types whose readings are only ingested when a data value changes, '
+                       'e.g. ddstop',
+        'type': 'string',
+        'default': '',
+        'order': '30',
+        'displayName': 'Report By Exception'
+    },
+    'heartbeatInterval': {
+        'description': 'Number of seconds after which an unchanged report-by-exception reading or a compressed '
+                       'reading is ingested again, 0 never ingests it again',
+        'type': 'integer',
+        'default': '300',
+        'order': '31',
+        'displayName': 'Heartbeat Interval',
+        'minimum': '0'
+    },
+    'deadbands': {
+        'description': 'Deadbands per stream type and field, absolute or in percent of the last ingested value, '
+                       'e.g. {"adstop": {"ANASEN_CH1": 0.5, "*": "1%"}}, stream types not listed are not compressed',
+        'type': 'JSON',
+        'default': '{}',
+        'order': '32',
+        'displayName': 'Deadbands'
+    },
+    'compressionMode': {
+        'description': 'Ingest a reading when a field leaves its deadband around the last ingested value, or when '
+                       'the fields leave their swinging-door corridor',
+        'type': 'enumeration',
+        'options': ['deadband', 'swinging-door'],
+        'default': 'deadband',
+        'order': '33',
+        'displayName': 'Compression Mode'
+    },
+    'spillFile': {
+        'description': 'Path of the file readings are spilled to while Fledge ingest falls behind, they are ingested '
+                       'from it once ingest recovers. Leave empty to always wait for ingest',
+        'type': 'string',
+        'default': '',
+        'order': '34',
+        'displayName': 'Spill File'
+    },
+    'spillFileSize': {
+        'description': 'Size in megabytes of a new spill file, readings are dropped once it is full',
+        'type': 'integer',
+        'default': '64',
+        'order': '35',
+        'displayName': 'Spill File Size (MB)',
+        'minimum': '1'
+    },
+    'spillQueueDepth': {
+        'description': 'Number of messages queued up during one ingest call from which readings are spilled',
+        'type': 'integer',
+        'default': '5000',
+        'order': '36',
+        'displayName': 'Spill Queue Depth',
+        'minimum': '1'
+    },
+    'spillLatency': {
+        'description': 'Duration in milliseconds of an ingest call from which readings are spilled',
+        'type': 'integer',
+        'default': '1000',
+        'order': '37',
+        'displayName': 'Spill Latency (ms)',
+        'minimum': '1'
+    },
+    'drainBatchSize': {
+        'description': 'Number of spilled readings sent to Fledge in one ingest call while the spill file drains',
+        'type': 'integer',
+        'default': '1000',
+        'order': '38',
+        'displayName': 'Drain Batch Size',
+        'minimum': '1'
+    },
+    'latencyTracing': {
+        'description': 'Record per device lag histograms of the stages from the device RTC to the ingest call',
+        'type': 'boolean',
+        'default': 'false',
+        'order': '39',
+        'displayName': 'Latency Tracing'
+    },
+    'traceSampleInterval': {
+        'description': 'One in this many readings carries a trace datapoint with its stage times and is written to '
+                       'the trace file, 0 traces none. Only with latency tracing',
+        'type': 'integer',
+        'default': '1000',
+        'order': '40',
+        'displayName': 'Trace Sample Interval',
+        'minimum': '0'
+    },
+    'traceFile': {
+        'description': 'Path of the file the sampled traces are appended to as JSON lines, leave empty to write '
+                       'them to the log',
+        'type': 'string',
+        'default': '',
+        'order': '41',
+        'displayName': 'Trace File'
     }
 }
 
@@ -156,7 +521,8 @@ def plugin_init(config):
     Raises:
     """
     handle = copy.deepcopy(config)
-    handle["_mqtt"] = MqttSubscriberClient(handle)
+    schemas = SchemaRegistry(_PLUGIN_DIR, int(handle['schemaCheckInterval']['value']))
+    handle["_mqtt"] = MqttSubscriberClient(handle, schemas)
     return handle
 
 
@@ -233,60 +599,218 @@ def plugin_register_ingest(handle, callback, ingest_ref):
     c_ingest_ref = ingest_ref
 
 
+def _receive_timestamp(received):
+    """ Returns a receive time of the monotonic clock as a Fledge reading timestamp """
+    wall = time.time() - (time.monotonic() - received)
+    return str(datetime.datetime.fromtimestamp(wall, datetime.timezone.utc).astimezone())
+
+
+def _service_name():
+    """ Returns the name of the south service running the plugin, the --name argument of the service process, or an
+    empty string when the process has none
+    """
+    for arg in getattr(sys, 'argv', None) or []:
+        if isinstance(arg, str) and arg.startswith('--name='):
+            return arg[len('--name='):]
+    return ''
+
+
 class MqttSubscriberClient(object):
     """ mqtt listener class"""
 
-    __slots__ = ['mqtt_client', 'broker_host', 'broker_port', 'topic', 'qos', 'keep_alive_interval', 'asset', 'loop']
-
-    def __init__(self, config):
-        self.mqtt_client = mqtt.Client()
+    __slots__ = ['mqtt_client', 'protocol', 'receive_maximum', 'session_expiry_interval', 'client_id',
+                 'persistent_session', 'reconnect_min_delay', 'reconnect_max_delay', 'reconnect_count', 'downtime',
+                 '_attempts', '_disconnected_at', '_network', '_stopping', 'broker_host', 'broker_port', 'topics',
+                 'qos', 'keep_alive_interval', 'asset', 'loop', 'schemas', '_routes', 'exception_streams', 'exceptions',
+                 'batch_decode', 'clock', 'device_timestamp', 'timestamp_datapoint', 'batcher', 'queue', '_worker',
+                 '_reported_drops', '_next_drop_report', 'metrics', 'metrics_interval', 'metrics_file', 'metrics_asset',
+                 '_next_report', 'payload_log_interval', '_next_payload_log', 'dead_letters', 'compressor',
+                 'json_decoder', 'spill', 'spill_queue_depth', 'spill_latency', 'drain_batch_size', '_spilling',
+                 '_next_probe', '_ingest_latency', '_ingest_growth', 'tracer']
+
+    def __init__(self, config, schemas):
         self.broker_host = config['brokerHost']['value']
         self.broker_port = int(config['brokerPort']['value'])
-        self.topic = config['topic']['value']
+        self.topics = [topic.strip() for topic in config['topic']['value'].split(',') if topic.strip()]
+        shared_group = config['sharedGroup']['value'].strip()
+        if shared_group:
+            self.topics = ['$share/{}/{}'.format(shared_group, topic) for topic in self.topics]
         self.qos = int(config['qos']['value'])
         self.keep_alive_interval = int(config['keepAliveInterval']['value'])
         self.asset = config['assetName']['value']
 
-    def on_connect(self, client, userdata, flags, rc):
+        self.protocol = mqtt.MQTTv5 if config['protocol']['value'] == 'MQTTv5' else mqtt.MQTTv311
+        self.receive_maximum = int(config['receiveMaximum']['value'])
+        self.session_expiry_interval = int(config['sessionExpiryInterval']['value'])
+        self.client_id = config['clientId']['value'].strip()
+        if not self.client_id:
+            self.client_id = self.stable_client_id()
+            if shared_group and not _service_name():
+                _LOGGER.error("Shared subscription group %s with a derived client id %s: services of the group with "
+                              "the same configuration on this host take each other's session over, give each of "
+                              "them its own Client Id", shared_group, self.client_id)
+        self.persistent_session = config['persistentSession']['value'] == 'true'
+        if self.protocol == mqtt.MQTTv5 and self.persistent_session and not self.session_expiry_interval:
+            # without a session expiry interval an MQTT v5 broker discards the session on disconnect
+            self.session_expiry_interval = _SESSION_NEVER_EXPIRES
+            _LOGGER.info("Persistent MQTT v5 session without a session expiry interval, the broker keeps it "
+                         "without expiry")
+        # reconnects are driven by the network thread, which applies the backoff
+        if self.protocol == mqtt.MQTTv5:
+            self.mqtt_client = mqtt.Client(self.client_id, protocol=self.protocol, reconnect_on_failure=False)
+        else:
+            self.mqtt_client = mqtt.Client(self.client_id, clean_session=not self.persistent_session,
+                                           protocol=self.protocol, reconnect_on_failure=False)
+        self.reconnect_min_delay = int(config['reconnectMinDelay']['value'])
+        self.reconnect_max_delay = max(self.reconnect_min_delay, int(config['reconnectMaxDelay']['value']))
+        self.reconnect_count = 0
+        self.downtime = 0.0
+        self._attempts = 0
+        self._disconnected_at = None
+        self._network = None
+        self._stopping = threading.Event()
+        self.schemas = schemas
+        self._routes = {}
+        self.exception_streams = frozenset(stream_type.strip() for stream_type in
+                                           config['reportByException']['value'].split(',') if stream_type.strip())
+        self.exceptions = ReportByException(int(config['heartbeatInterval']['value']), _MAX_ROUTES)
+        self.compressor = Compressor(parse_deadbands(config['deadbands']['value']),
+                                     config['compressionMode']['value'], int(config['heartbeatInterval']['value']),
+                                     _MAX_ROUTES)
+        self.json_decoder = JsonDecoder()
+        self.batch_decode = config['batchDecode']['value'] == 'true'
+        self.clock = RtcClock(config['deviceTimezone']['value'].strip())
+        self.device_timestamp = config['timestampSource']['value'] == 'device'
+        self.timestamp_datapoint = config['timestampDatapoint']['value'] == 'true'
+        self.batcher = ReadingBatcher(int(config['ingestBatchSize']['value']),
+                                      int(config['ingestBatchAge']['value']) / 1000)
+        self.queue = BoundedQueue(int(config['ingestQueueSize']['value']), config['ingestQueuePolicy']['value'])
+        self._worker = None
+        self._reported_drops = 0
+        self._next_drop_report = 0.0
+        self.metrics = IngestMetrics()
+        self.metrics_interval = int(config['metricsInterval']['value'])
+        self.metrics_file = config['metricsFile']['value'].strip()
+        self.metrics_asset = config['metricsAsset']['value'].strip()
+        self._next_report = time.monotonic() + self.metrics_interval
+        self.payload_log_interval = int(config['payloadLogInterval']['value'])
+        self._next_payload_log = 0.0
+        dead_letter_file = config['deadLetterFile']['value'].strip()
+        self.dead_letters = None
+        if dead_letter_file:
+            self.dead_letters = DeadLetterStore(dead_letter_file,
+                                                int(config['deadLetterFileSize']['value']) * 1024 * 1024)
+        spill_file = config['spillFile']['value'].strip()
+        self.spill = None
+        if spill_file:
+            self.spill = SpillBuffer(spill_file, int(config['spillFileSize']['value']) * 1024 * 1024)
+        self.spill_queue_depth = int(config['spillQueueDepth']['value'])
+        self.spill_latency = int(config['spillLatency']['value']) / 1000
+        self.drain_batch_size = int(config['drainBatchSize']['value'])
+        self._spilling = False
+        self._next_probe = 0.0
+        self._ingest_latency = 0.0
+        self._ingest_growth = 0
+        self.tracer = None
+        if config['latencyTracing']['value'] == 'true':
+            self.tracer = LatencyTracer(self.clock, int(config['traceSampleInterval']['value']),
+                                        config['traceFile']['value'].strip())
+
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         """ The callback for when the client receives a CONNACK response from the server
         """
-        client.connected_flag = True
-        # subscribe at given Topic on connect
-        client.subscribe(self.topic, self.qos)
-        _LOGGER.info("MQTT connected. Subscribed the topic: %s", self.topic)
+        if rc != 0:
+            _LOGGER.error("MQTT broker refused the connection: %s", mqtt.connack_string(rc)
+                          if isinstance(rc, int) else str(rc))
+            return
 
-    def on_disconnect(self, client, userdata, rc):
-        pass
+        client.connected_flag = True
+        self._attempts = 0
+        if self._disconnected_at is not None:
+            downtime = time.monotonic() - self._disconnected_at
+            self._disconnected_at = None
+            self.reconnect_count += 1
+            self.downtime += downtime
+            _LOGGER.warning("MQTT reconnected after %.1f seconds. Reconnects: %s, total downtime: %.1f seconds",
+                            downtime, self.reconnect_count, self.downtime)
+
+        # subscribe at given Topics on connect
+        client.subscribe([(topic, self.qos) for topic in self.topics])
+        _LOGGER.info("MQTT connected. Subscribed the topics: %s", self.topics)
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        client.connected_flag = False
+        if self._disconnected_at is None and not self._stopping.is_set():
+            self._disconnected_at = time.monotonic()
+            _LOGGER.warning("MQTT connection lost: %s", mqtt.error_string(rc) if isinstance(rc, int) else str(rc))
+
+    def stable_client_id(self):
+        """ Returns a client id derived from the broker, topics, asset name, host and service name, which stays the same
+        across restarts and differs between services of a shared subscription group
+        """
+        identity = '|'.join([self.broker_host, str(self.broker_port), self.asset] + self.topics +
+                            [socket.gethostname(), _service_name()])
+        return 'fledge-mqtt-' + hashlib.sha1(identity.encode()).hexdigest()[:16]
 
     def on_message(self, client, userdata, msg):
         """ The callback for when a PUBLISH message is received from the server
         """
-        _LOGGER.info("MQTT Received message; Topic: %s, Payload: %s  with QoS: %s", str(msg.topic), str(msg.payload),
-                     str(msg.qos))
-        
-        #Save ADS data
-        if "adstop" in str(msg.topic):
-          self.loop.run_until_complete(self.save_ads(msg))
-        
-        #Save PDS data
-        if "pdstop" in str(msg.topic):
-            self.loop.run_until_complete(self.save_pds(msg))
-
-        #Save DDS data
-        if "ddstop" in str(msg.topic):
-            self.loop.run_until_complete(self.save_dds(msg))
-        
-        #Save PQ data
-        if "pqstop" in str(msg.topic):
-            self.loop.run_until_complete(self.save_pq(msg))
-
-    def on_subscribe(self, client, userdata, mid, granted_qos):
+        if self.payload_log_interval:
+            now = time.monotonic()
+            if now >= self._next_payload_log:
+                self._next_payload_log = now + self.payload_log_interval
+                _LOGGER.info("MQTT Received message; Topic: %s, Payload: %s  with QoS: %s", str(msg.topic),
+                             str(msg.payload), str(msg.qos))
+
+        route = self.route(msg.topic)
+        if route is None:
+            _LOGGER.debug("Ignoring message on topic %s, no stream type matches it", msg.topic)
+            return
+
+        # decoding and ingest run on the ingest thread, the network thread only hands the message over
+        self.queue.put((route, msg))
+
+    def route(self, topic):
+        """ Returns the stream type, the asset name and the metrics counters of a message topic
+
+        The stream type is the last level of the topic and the device id the level before it, so a
+        wildcard subscription such as +/+ can feed every device of a site into one service. Routes of
+        known stream types are cached per topic, a schema file added later is picked up by new messages.
+
+        Args:
+            topic: topic of the received message
+        Returns:
+            (stream type, asset name, counters) tuple, None if the topic does not end with a known stream type
+        """
+        try:
+            return self._routes[topic]
+        except KeyError:
+            pass
+
+        levels = topic.split('/')
+        stream_type = levels[-1]
+        device = levels[-2] if len(levels) > 1 else ''
+        if stream_type not in self.schemas:
+            return None
+        route = (stream_type, self.asset.replace('{device}', device).replace('{stream}', stream_type),
+                 self.metrics.counters(stream_type, device))
+
+        if len(self._routes) >= _MAX_ROUTES:
+            self._routes.clear()
+        self._routes[topic] = route
+        return route
+
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
         pass
 
     def on_unsubscribe(self, client, userdata, mid):
         pass
 
     def start(self):
+        # the ingest thread owns the event loop for the lifetime of the client
+        self._worker = threading.Thread(target=self._ingest_worker, name='mqtt-ingest', daemon=True)
+        self._worker.start()
+
         # event callbacks
         self.mqtt_client.on_connect = self.on_connect
 
@@ -295,248 +819,471 @@ class MqttSubscriberClient(object):
 
         self.mqtt_client.on_disconnect = self.on_disconnect
 
-        self.mqtt_client.connect(self.broker_host, self.broker_port, self.keep_alive_interval)
-        _LOGGER.info("MQTT connecting..., Broker Host: %s, Port: %s", self.broker_host, self.broker_port)
-
-        self.mqtt_client.loop_start()
+        if self.protocol == mqtt.MQTTv5:
+            properties = Properties(PacketTypes.CONNECT)
+            if self.receive_maximum:
+                properties.ReceiveMaximum = self.receive_maximum
+            if self.session_expiry_interval:
+                properties.SessionExpiryInterval = self.session_expiry_interval
+            self.mqtt_client.connect_async(self.broker_host, self.broker_port, self.keep_alive_interval,
+                                           clean_start=not self.persistent_session, properties=properties)
+        else:
+            self.mqtt_client.connect_async(self.broker_host, self.broker_port, self.keep_alive_interval)
+        _LOGGER.info("MQTT connecting..., Broker Host: %s, Port: %s, Client Id: %s", self.broker_host,
+                     self.broker_port, self.client_id)
+
+        self._network = threading.Thread(target=self._network_loop, name='mqtt-network', daemon=True)
+        self._network.start()
 
     def stop(self):
+        self._stopping.set()
         self.mqtt_client.disconnect()
-        self.mqtt_client.loop_stop()
-
-    async def save_ads(self, msg):
-        """Store msg content to Fledge with support for binary and JSON payloads."""
-        try:
-            
-            # Read the data back from the JSON file
-            with open('/usr/local/fledge/python/fledge/plugins/south/mqtt-readings-binary/ads.json', 'r') as json_file:
-                ads_data = json.load(json_file)
-
-            # Access the struct_format and field_names
-            struct_format = ads_data['struct_format']
-            field_names = ads_data['field_names']
-
-            struct_size = struct.calcsize(struct_format)
-
-            # Ensure payload size matches struct size
-            if len(msg.payload) != struct_size:
-                raise ValueError(f"Payload size {len(msg.payload)} does not match expected size {struct_size}.")
-
-            # Unpack the payload
-            unpacked_data = struct.unpack(struct_format, msg.payload)
-
-            # Extract data
-            analog_data = unpacked_data[:4]
-            timestamp = unpacked_data[4:11]  # seconds, minutes, hours, weekday, date, month, year
-            is_nlf = unpacked_data[11]
-
-            # Handle year correctly
-            year = timestamp[6] if timestamp[6] > 99 else 2000 + timestamp[6]
-
-            # Format timestamp
-            formatted_timestamp = f"{year}-{timestamp[5]:02d}-{timestamp[4]:02d} {timestamp[2]:02d}:{timestamp[1]:02d}:{timestamp[0]:02d}"
-
-            # Build the JSON object
-            payload_data = {
-                "ANASEN_CH1": analog_data[0],
-                "ANASEN_CH2": analog_data[1],
-                "ANASEN_CH3": analog_data[2],
-                "ANASEN_CH4": analog_data[3],
-                "timestamp": formatted_timestamp,
-                "IsNlf": is_nlf,
-                "topic": str(msg.topic)
-            }
-        except:
-                # If decoding fails, treat it as binary data
-            payload_data = {
-                'binary_data': list(msg.payload)  # Convert binary payload to a list of integers
-            }
-        
-        # Prepare data for ingestion
-        _LOGGER.debug("Ingesting data on topic %s: %s", str(msg.topic), payload_data)
-        data = {
-            'asset': self.asset,
-            'timestamp': utils.local_timestamp(),
-            'readings': payload_data
-        }
-        
-        # Use async_ingest callback to save data
-        await async_ingest.ingest_callback(c_callback, c_ingest_ref, data)
+        if self._network is not None:
+            self._network.join(_STOP_TIMEOUT)
+            if self._network.is_alive():
+                # a connect in flight when disconnect ran leaves the network loop on an open socket, shutting it
+                # down makes paho see a lost connection
+                sock = self.mqtt_client.socket()
+                if sock is not None:
+                    try:
+                        sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                self._network.join(_STOP_TIMEOUT)
+            if self._network.is_alive():
+                # the daemon thread is still stuck in the TCP connect, it stops at the next check of _stopping
+                _LOGGER.warning("MQTT network thread did not stop within %s seconds, shutting down without it",
+                                2 * _STOP_TIMEOUT)
+            self._network = None
+
+        # the ingest thread drains the queued messages and flushes the last batch before it exits
+        self.queue.close()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        _LOGGER.info("MQTT ingest queue statistics: %s, batch statistics: %s, totals: %s", self.queue.stats(),
+                     self.batcher.stats(), self.metrics.totals())
+
+    def _network_loop(self):
+        """ Connects to the broker and runs the paho network loop, runs on its own thread
+
+        When the connection fails or is lost the next attempt waits for an exponentially growing delay with random
+        jitter, so that a broker restart is not answered by every south service reconnecting at the same moment.
+        """
+        while not self._stopping.is_set():
+            try:
+                self.mqtt_client.reconnect()
+            except (OSError, ValueError) as ex:
+                reason = str(ex)
+            else:
+                if self._stopping.is_set():
+                    # stop ran while the connect was in flight, its disconnect did not reach this connection
+                    self.mqtt_client.disconnect()
+                    break
+                # returns once the connection is lost or the client is disconnected
+                self.mqtt_client.loop_forever()
+                reason = 'connection closed'
+            if self._stopping.is_set():
+                break
+
+            self._attempts += 1
+            delay = self.reconnect_delay(self._attempts)
+            _LOGGER.warning("MQTT broker %s:%s unavailable (%s), reconnect attempt %s in %.1f seconds",
+                            self.broker_host, self.broker_port, reason, self._attempts, delay)
+            self._stopping.wait(delay)
+
+    def reconnect_delay(self, attempt):
+        """ Returns the jittered exponential backoff delay in seconds before the given reconnect attempt
+        """
+        delay = min(self.reconnect_max_delay, self.reconnect_min_delay * 2 ** min(attempt - 1, 16))
+        return random.uniform(delay / 2, delay)
 
+    def _ingest_worker(self):
+        """ Decodes and ingests the queued messages on the event loop, runs on its own thread
+        """
+        asyncio.set_event_loop(self.loop)
+        while True:
+            # wake up in time to send a pending batch that reaches its age limit and to report the metrics
+            wait = self._next_report - time.monotonic()
+            flush_wait = self.batcher.time_to_flush()
+            if flush_wait is not None and flush_wait < wait:
+                wait = flush_wait
+            if self.spill is not None and len(self.spill):
+                # keep draining the spill file, or wait for the next probe of a slow ingest
+                drain_wait = self._next_probe - time.monotonic() if self._spilling else 0.0
+                if drain_wait < wait:
+                    wait = drain_wait
+            messages = self.queue.get_many(self.batcher.max_size, max(0.0, wait))
+            if messages is None:
+                break
+            try:
+                self.loop.run_until_complete(self._process(messages))
+                if self.spill is not None and len(self.spill):
+                    self.loop.run_until_complete(self._drain())
+            except Exception as ex:
+                _LOGGER.exception("Failed to ingest MQTT messages: %s", str(ex))
+            self._report_drops()
 
-    async def save_pds(self, msg):
-        """Store msg content to Fledge with support for binary and JSON payloads."""
         try:
-            # Read the data back from the JSON file
-            with open('/usr/local/fledge/python/fledge/plugins/south/mqtt-readings-binary/pds.json', 'r') as json_file:
-                pds_data = json.load(json_file)
-
-            # Access the struct_format and field_names
-            struct_format = pds_data['struct_format']
-            field_names = pds_data['field_names']
-            #Calculate struct size
-            struct_size = struct.calcsize(struct_format)
-
-            # Ensure payload size matches struct size
-            if len(msg.payload) != struct_size:
-                raise ValueError(f"Payload size {len(msg.payload)} does not match expected size {struct_size}.")
-
-
-            #Unpack the payload
-            unpacked_data = struct.unpack(struct_format, msg.payload)
-            
-            #convert into json payload
-            json_payload = {field_name: value for field_name, value in zip(field_names, unpacked_data)}
-
-           # Parse and format timestamp
-            timestamp_data = unpacked_data[-8:-1]
-            seconds, minutes, hours, weekday, date, month, year = timestamp_data
-            year = int(year) if year > 99 else 2000 + int(year)
-            formatted_timestamp = f"{year}-{int(month):02d}-{int(date):02d} {int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
-            json_payload["timestamp"] = formatted_timestamp
-            
-            # Convert IsNlf to boolean
-            json_payload["IsNlf"] = bool(unpacked_data[-1])
-
-            # send topic type
-            json_payload["topic"] = str(msg.topic)
-
-            #Assign to payload_data
-            payload_data = json_payload
-
-        except:
-                # If decoding fails, treat it as binary data
-            payload_data = {
-                'binary_data': list(msg.payload)  # Convert binary payload to a list of integers
-            }
-        
-        # Prepare data for ingestion
-        _LOGGER.debug("Ingesting data on topic %s: %s", str(msg.topic), payload_data)
-        data = {
-            'asset': self.asset,
-            'timestamp': utils.local_timestamp(),
-            'readings': payload_data
-        }
-        
-        # Use async_ingest callback to save data
-        await async_ingest.ingest_callback(c_callback, c_ingest_ref, data)
-
-    async def save_dds(self, msg):
-        """Store msg content to Fledge with support for binary and JSON payloads."""
+            self.loop.run_until_complete(self._flush_held())
+            self.loop.run_until_complete(self.flush())
+            # while ingest keeps up the spill file is drained before the service stops
+            while self.spill is not None and len(self.spill) and not self._spilling:
+                self.loop.run_until_complete(self._drain())
+        except Exception as ex:
+            _LOGGER.exception("Failed to ingest MQTT messages: %s", str(ex))
+        self._write_metrics()
+        if self.dead_letters is not None:
+            self.dead_letters.close()
+        if self.spill is not None:
+            if len(self.spill):
+                _LOGGER.warning("%s readings stay in the spill file %s until the next start", len(self.spill),
+                                self.spill.path)
+            self.spill.close()
+        if self.tracer is not None:
+            self.tracer.close()
+
+    async def _process(self, messages):
+        """ Decodes and saves the messages of a chunk, a message that fails only loses its own readings """
+        if self.batch_decode:
+            # decode the messages of each stream type in one go
+            groups = {}
+            for route, msg in messages:
+                groups.setdefault(route[0], []).append((route, msg))
+            for stream_type, group in groups.items():
+                try:
+                    readings = self.decode_batch(stream_type, group)
+                except Exception:
+                    # decode() handles the failures of single messages
+                    readings = [None] * len(group)
+                    for index, (route, msg) in enumerate(group):
+                        try:
+                            readings[index] = self.decode(route, msg)
+                        except Exception as ex:
+                            self._message_failed(route, msg, ex)
+                for (route, msg), payload_data in zip(group, readings):
+                    try:
+                        await self._save_message(route, msg, payload_data)
+                    except Exception as ex:
+                        self._message_failed(route, msg, ex)
+        else:
+            for route, msg in messages:
+                try:
+                    await self._save_message(route, msg, self.decode(route, msg))
+                except Exception as ex:
+                    self._message_failed(route, msg, ex)
+        if self.batcher.time_to_flush() == 0:
+            await self.flush()
+        if time.monotonic() >= self._next_report:
+            self._next_report = time.monotonic() + self.metrics_interval
+            await self.report_metrics()
+
+    async def _save_message(self, route, msg, payload_data):
+        if payload_data.__class__ is list:
+            for reading in payload_data:
+                await self.save(route, msg.topic, reading, msg.timestamp)
+        elif payload_data is not None:
+            await self.save(route, msg.topic, payload_data, msg.timestamp)
+
+    def _message_failed(self, route, msg, ex):
+        """ Counts a message that could not be decoded or saved, the log doubles its interval per device """
+        counters = route[2]
+        counters.ingest_failures += 1
+        if not counters.ingest_failures & (counters.ingest_failures - 1):
+            _LOGGER.error("Failed to ingest MQTT message on topic %s, %s failures so far: %s", msg.topic,
+                          counters.ingest_failures, str(ex), exc_info=counters.ingest_failures == 1)
+
+    async def report_metrics(self):
+        """ Writes the metrics file and ingests the metrics totals, whichever is configured
+        """
+        if self.spill is not None:
+            self.spill.update_rates()
+        self._write_metrics()
+        if self.metrics_asset:
+            readings = self.metrics.totals()
+            readings['queue_depth'] = self.queue.depth
+            readings['queue_dropped'] = self.queue.dropped
+            readings['reconnects'] = self.reconnect_count
+            readings['downtime'] = self.downtime
+            if self.dead_letters is not None:
+                readings['dead_letters'] = self.dead_letters.count
+                readings['dead_letters_dropped'] = self.dead_letters.dropped
+            if self.spill is not None:
+                readings['spill_pending'] = self.spill.pending
+                readings['spill_rate'] = self.spill.spill_rate
+                readings['drain_rate'] = self.spill.drain_rate
+                readings['spill_dropped'] = self.spill.dropped
+            await self.ingest({
+                'asset': self.metrics_asset,
+                'timestamp': utils.local_timestamp(),
+                'readings': readings
+            })
+
+    def _write_metrics(self):
+        if not self.metrics_file:
+            return
+        snapshot = self.metrics.snapshot(queue=self.queue.stats(), batches=self.batcher.stats(),
+                                         schemaReloads=self.schemas.reload_count,
+                                         connection={'reconnects': self.reconnect_count, 'downtime': self.downtime})
+        if self.spill is not None:
+            snapshot['spill'] = self.spill.stats()
         try:
+            write_snapshot(self.metrics_file, snapshot)
+        except (OSError, TypeError, ValueError) as ex:
+            _LOGGER.error("Failed to write the MQTT ingest metrics to %s: %s", self.metrics_file, str(ex))
+
+    def _report_drops(self):
+        dropped = self.queue.dropped
+        if dropped == self._reported_drops:
+            return
+        now = time.monotonic()
+        if now < self._next_drop_report:
+            return
+        _LOGGER.warning("MQTT ingest queue overflow, %s messages dropped so far. Queue statistics: %s",
+                        dropped, self.queue.stats())
+        self._reported_drops = dropped
+        self._next_drop_report = now + _DROP_REPORT_INTERVAL
+
+    async def ingest(self, data):
+        """ Adds a reading to the ingest batch and sends the batch to Fledge when it is full
+        """
+        batch = self.batcher.add(data)
+        if batch:
+            await self._send(batch)
 
-            with open('/usr/local/fledge/python/fledge/plugins/south/mqtt-readings-binary/dds.json', 'r') as json_file:
-                dds_data = json.load(json_file)
-
-            # Access the struct_format and field_names
-            struct_format = dds_data['struct_format']
-            field_names = dds_data['field_names']
-
-            struct_size = struct.calcsize(struct_format)
+    async def flush(self):
+        """ Sends every pending reading to Fledge
+        """
+        batch = self.batcher.take()
+        if batch:
+            await self._send(batch)
+
+    async def _send(self, batch):
+        if self.tracer is not None:
+            self.tracer.submitted(batch)
+        if self.spill is not None and (len(self.spill) or self._falls_behind()):
+            self._spill(batch)
+            return
+        await self._ingest_batch(batch)
+
+    async def _ingest_batch(self, batch):
+        start = time.perf_counter()
+        depth = self.queue.depth
+        await async_ingest.ingest_callback(c_callback, c_ingest_ref, batch)
+        self._ingest_latency = time.perf_counter() - start
+        # messages that queued up while Fledge held the ingest thread, a decode backlog does not grow the queue here
+        self._ingest_growth = self.queue.depth - depth
+        self.metrics.add_ingest(self._ingest_latency)
+
+    def _falls_behind(self):
+        return self._ingest_latency >= self.spill_latency or self._ingest_growth >= self.spill_queue_depth
+
+    def _spill(self, batch):
+        """ Appends a batch to the spill file, readings are kept in order behind the ones already spilled """
+        if not self._spilling and not len(self.spill):
+            self._spilling = True
+            self._next_probe = time.monotonic() + _SPILL_PROBE_INTERVAL
+            _LOGGER.warning("Fledge ingest falls behind (last ingest call %.3f seconds, %s messages queued up during "
+                            "it), spilling readings to %s", self._ingest_latency, self._ingest_growth, self.spill.path)
+        if not self.spill.append(batch) and self.spill.dropped == len(batch):
+            _LOGGER.warning("Spill file %s is full, further readings are dropped until it drains", self.spill.path)
+
+    async def _drain(self):
+        """ Ingests a batch of spilled readings unless Fledge ingest still falls behind
+
+        While ingest is too slow a drain is only tried once per probe interval, it measures the ingest latency again.
+        """
+        now = time.monotonic()
+        if self._spilling and now < self._next_probe:
+            return
+        await self._ingest_batch(self.spill.take(self.drain_batch_size))
+        if self._falls_behind():
+            self._spilling = True
+            self._next_probe = time.monotonic() + _SPILL_PROBE_INTERVAL
+        elif self._spilling:
+            self._spilling = False
+            _LOGGER.info("Fledge ingest recovered, draining %s spilled readings from %s", len(self.spill),
+                         self.spill.path)
+        if not len(self.spill):
+            _LOGGER.info("Spill file %s drained, %s readings spilled so far", self.spill.path, self.spill.spilled)
+
+    def decode(self, route, msg):
+        """ Decodes a binary or JSON payload into reading datapoints, undecodable payloads become dead letters
+
+        Returns:
+            reading datapoints, a list of them for an envelope, None if report-by-exception suppresses the message
+        """
+        stream_type, _, counters = route
+        payload = msg.payload
+        start = time.perf_counter()
+        counters.messages += 1
+        counters.bytes += len(payload)
+        try:
+            schema = self.schemas.get(stream_type)
+            if stream_type != schema.stream_type:
+                # the JSON stream type of the schema
+                payload_data = self.json_decoder.decode(schema, stream_type, payload, msg.topic)
+                counters.decode_latency.add(time.perf_counter() - start)
+                return payload_data
 
             # Ensure payload size matches struct size
-            if len(msg.payload) != struct_size:
-                raise ValueError(f"Payload size {len(msg.payload)} does not match expected size {struct_size}.")
-
-            # Unpack the payload
-            unpacked_data = struct.unpack(struct_format, msg.payload)
-
-            # Extract data
-            digital_data = unpacked_data[:8]
-            timestamp = unpacked_data[8:15]  # seconds, minutes, hours, weekday, date, month, year
-            is_nlf = unpacked_data[15]
-
-            # Handle year correctly
-            year = timestamp[6] if timestamp[6] > 99 else 2000 + timestamp[6]
-
-            # Format timestamp
-            formatted_timestamp = f"{year}-{timestamp[5]:02d}-{timestamp[4]:02d} {timestamp[2]:02d}:{timestamp[1]:02d}:{timestamp[0]:02d}"
-
-            # Build the JSON object
-            payload_data = {
-            "Digi1": digital_data[0],
-            "Digi2": digital_data[1],
-            "Digi3": digital_data[2],
-            "Digi4": digital_data[3],
-            "Digi5": digital_data[4],
-            "Digi6": digital_data[5],
-            "Digi7": digital_data[6],
-            "Digi8": digital_data[7],
-            "timestamp": formatted_timestamp,
-            "IsNlf": is_nlf,
-            "topic": str(msg.topic)
-            }
-        except:
-                # If decoding fails, treat it as binary data
-            payload_data = {
+            if len(payload) != schema.size:
+                if is_envelope(payload):
+                    payload_data = self.decode_envelope(schema, msg, counters)
+                    counters.decode_latency.add(time.perf_counter() - start)
+                    return payload_data
+                counters.size_mismatches += 1
+                raise ValueError(f"Payload size {len(payload)} does not match expected size {schema.size}.")
+
+            # Unpack the payload, unchanged report-by-exception states are not decoded any further
+            values = schema.struct.unpack(payload)
+            if stream_type in self.exception_streams and not self.exceptions.report(
+                    msg.topic, values[:schema.data_count], msg.timestamp):
+                counters.suppressed += 1
+                payload_data = None
+            else:
+                payload_data = schema.decode(values, msg.topic)
+        except Exception:
+            counters.decode_failures += 1
+            payload_data = self.dead_letter(msg)
+        counters.decode_latency.add(time.perf_counter() - start)
+        return payload_data
+
+    def decode_envelope(self, schema, msg, counters):
+        """ Decodes the records of an envelope payload, see mrb_envelope.py
+
+        Returns:
+            list of reading datapoints, without the records suppressed by report-by-exception
+        """
+        topic = msg.topic
+        build = schema.decode
+        records = iter_records(schema, msg.payload)
+        counters.envelopes += 1
+        counters.envelope_records += (len(msg.payload) - ENVELOPE_HEADER.size) // schema.size
+        if schema.stream_type not in self.exception_streams:
+            return [build(values, topic) for values in records]
+
+        readings = []
+        for values in records:
+            if self.exceptions.report(topic, values[:schema.data_count], msg.timestamp):
+                readings.append(build(values, topic))
+            else:
+                counters.suppressed += 1
+        return readings
+
+    def dead_letter(self, msg):
+        """ Stores an undecodable message in the dead-letter file and returns the counter reading ingested for it
+        """
+        if self.dead_letters is None:
+            # If decoding fails, treat it as binary data
+            return {
                 'binary_data': list(msg.payload)  # Convert binary payload to a list of integers
             }
-        
-        # Prepare data for ingestion
-        _LOGGER.debug("Ingesting data on topic %s: %s", str(msg.topic), payload_data)
-        data = {
-            'asset': self.asset,
-            'timestamp': utils.local_timestamp(),
-            'readings': payload_data
+
+        # paho stamps messages with the monotonic clock on receipt
+        received = time.time() - (time.monotonic() - msg.timestamp)
+        topic = msg.topic
+        if not self.dead_letters.append(topic, msg.payload, received) and self.dead_letters.dropped == 1:
+            _LOGGER.warning("Dead letter file %s is full, further undecodable payloads are dropped",
+                            self.dead_letters.path)
+        return {
+            'dead_letters': self.dead_letters.count + self.dead_letters.dropped,
+            'topic': topic
         }
-        
-        # Use async_ingest callback to save data
-        await async_ingest.ingest_callback(c_callback, c_ingest_ref, data)
 
-    async def save_pq(self, msg):
-        """Store msg content to Fledge with support for binary and JSON payloads."""
-        try:
-            # Read the data back from the JSON file
-            with open('/usr/local/fledge/python/fledge/plugins/south/mqtt-readings-binary/pqs.json', 'r') as json_file:
-                pqs_data = json.load(json_file)
+    def decode_batch(self, stream_type, messages):
+        """ Decodes many payloads of one stream type with a single struct.iter_unpack over their concatenation
 
-            # Access the struct_format and field_names
-            struct_format = pqs_data ['struct_format']
-            field_names = pqs_data ['field_names']
+        Payloads whose size does not match the schema go through decode() and keep their position.
 
-            #Calculate struct size
-            struct_size = struct.calcsize(struct_format)
+        Args:
+            stream_type: stream type of every message
+            messages: list of (route, message) tuples
+        Returns:
+            list of reading datapoints, one per message, None for messages suppressed by report-by-exception and a
+            list of reading datapoints for envelopes
+        """
+        schema = self.schemas.get(stream_type)
+        if stream_type != schema.stream_type:
+            return [self.decode(route, msg) for route, msg in messages]
+        sized = [msg.payload for _, msg in messages if len(msg.payload) == schema.size]
+        if len(sized) < _MIN_BATCH_DECODE:
+            return [self.decode(route, msg) for route, msg in messages]
+
+        start = time.perf_counter()
+        rows = schema.struct.iter_unpack(b''.join(sized))
+        build = schema.decode
+        by_exception = stream_type in self.exception_streams
+        readings = []
+        decoded = []
+        for route, msg in messages:
+            if len(msg.payload) == schema.size:
+                values = next(rows)
+                if by_exception and not self.exceptions.report(msg.topic, values[:schema.data_count], msg.timestamp):
+                    route[2].suppressed += 1
+                    readings.append(None)
+                else:
+                    readings.append(build(values, msg.topic))
+                decoded.append(route[2])
+            else:
+                readings.append(self.decode(route, msg))
+
+        # the batch latency is shared evenly by the messages decoded in it
+        latency = (time.perf_counter() - start) / len(decoded)
+        for counters in decoded:
+            counters.messages += 1
+            counters.bytes += schema.size
+            counters.decode_latency.add(latency)
+        return readings
+
+    async def save(self, route, topic, payload_data, received):
+        """ Queues the datapoints of one message as a reading for the next ingest batch
+
+        Readings of compressed stream types are only queued when they pass compression.
+
+        Args:
+            route: route of the message topic
+            topic: topic of the message
+            payload_data: reading datapoints
+            received: receive time of the message in seconds of the monotonic clock
+        """
+        stream_type, asset, counters = route
+        if self.tracer is not None:
+            rtc_time = payload_data.get('timestamp')
+        timestamp = None
+        if self.device_timestamp and 'timestamp' in payload_data:
+            rtc = payload_data['timestamp']
+            if rtc.__class__ is str:
+                timestamp = self.clock.timestamp(rtc)
+            if timestamp is None:
+                # the device sent no valid RTC time, the receive time is the closest to it
+                timestamp = _receive_timestamp(received)
+        if not self.timestamp_datapoint:
+            payload_data.pop('timestamp', None)
 
-            # Ensure payload size matches struct size
-            if len(msg.payload) != struct_size:
-                raise ValueError(f"Payload size {len(msg.payload)} does not match expected size {struct_size}.")
-
-
-            #Unpack the payload
-            unpacked_data = struct.unpack(struct_format, msg.payload)
-            
-            #convert into json payload
-            json_payload = {field_name: value for field_name, value in zip(field_names, unpacked_data)}
-
-           # Parse and format timestamp
-            timestamp_data = unpacked_data[-8:-1]
-            seconds, minutes, hours, weekday, date, month, year = timestamp_data
-            year = int(year) if year > 99 else 2000 + int(year)
-            formatted_timestamp = f"{year}-{int(month):02d}-{int(date):02d} {int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}"
-            json_payload["timestamp"] = formatted_timestamp
-            
-            # Convert IsNlf to boolean
-            json_payload["IsNlf"] = bool(unpacked_data[-1])
-
-             # send topic type
-            json_payload["topic"] = str(msg.topic)
-
-            #Assign to payload_data
-            payload_data = json_payload
-
-        except:
-                # If decoding fails, treat it as binary data
-            payload_data = {
-                'binary_data': list(msg.payload)  # Convert binary payload to a list of integers
-            }
-        
         # Prepare data for ingestion
-        _LOGGER.debug("Ingesting PQ data on topic %s: %s", str(msg.topic), payload_data)
+        _LOGGER.debug("Ingesting data on topic %s: %s", topic, payload_data)
         data = {
-            'asset': self.asset,
-            'timestamp': utils.local_timestamp(),
+            'asset': asset,
+            'timestamp': timestamp or utils.local_timestamp(),
             'readings': payload_data
         }
-        
-        # Use async_ingest callback to save data
-        await async_ingest.ingest_callback(c_callback, c_ingest_ref, data)
\ No newline at end of file
+        if self.tracer is not None:
+            self.tracer.stamp(data, counters, received, rtc_time)
+        if stream_type in self.compressor.streams:
+            data = self.compressor.offer(stream_type, self.schemas.get(stream_type), topic, data, received)
+            if data is None:
+                counters.suppressed += 1
+                return
+        counters.readings += 1
+        await self.ingest(data)
+
+    async def _flush_held(self):
+        """ Ingests the readings swinging-door compression still holds back """
+        for topic, data in self.compressor.pending():
+            route = self.route(topic)
+            if route is not None:
+                # the reading was counted as suppressed when it was held back
+                route[2].suppressed -= 1
+                route[2].readings += 1
+            await self.ingest(data)
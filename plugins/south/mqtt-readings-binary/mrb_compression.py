@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Deadband and swinging-door compression of analog readings
+
+The deadbands are configured per stream type and data field, either absolute or as a percentage of the last
+ingested value, e.g. {"adstop": {"ANASEN_CH1": 0.5, "*": "1%"}}. The "*" entry applies to every field that is not
+listed. Fields without a deadband and without a "*" entry have a deadband of 0, so any change of them is ingested.
+
+Modes:
+    deadband       a reading is ingested when any field moved by more than its deadband since the last ingested
+                   reading of the same topic, i.e. of the same device and stream
+    swinging-door  a reading is ingested when the fields can no longer be interpolated within their deadband
+                   by a straight line from the last ingested reading; as usual for swinging-door the reading in
+                   front of the one that closed the door is ingested, so ingest lags one reading behind
+
+Either way a reading is ingested once the last ingested reading of the topic is heartbeat seconds old. The state
+of every topic is held in arrays of doubles indexed by the field position.
+"""
+
+import array
+import json
+import logging
+import operator
+
+from fledge.common import logger
+
+_LOGGER = logger.setup(__name__, level=logging.INFO)
+
+DEADBAND = 'deadband'
+SWINGING_DOOR = 'swinging-door'
+
+MODES = (DEADBAND, SWINGING_DOOR)
+
+_ALL_FIELDS = '*'
+
+
+def _parse_deadband(value):
+    """ Returns (absolute, percent as a fraction) of a deadband such as 0.5, "0.5" or "2%" """
+    if isinstance(value, str) and value.strip().endswith('%'):
+        percent = float(value.strip()[:-1]) / 100
+        absolute = 0.0
+    else:
+        absolute = float(value)
+        percent = 0.0
+    if absolute < 0 or percent < 0:
+        raise ValueError("Negative deadband {}".format(value))
+    return absolute, percent
+
+
+def parse_deadbands(deadbands):
+    """ Parses the deadband configuration
+
+    Args:
+        deadbands: JSON string or dictionary of stream type to a dictionary of field name to deadband
+    Returns:
+        dictionary of stream type to a dictionary of field name to (absolute, percent) deadband
+    Raises:
+        ValueError: if the configuration is not valid
+    """
+    if isinstance(deadbands, str):
+        deadbands = json.loads(deadbands) if deadbands.strip() else {}
+    if not isinstance(deadbands, dict):
+        raise ValueError("Deadbands must be a JSON object keyed by stream type")
+    parsed = {}
+    for stream_type, fields in deadbands.items():
+        if not isinstance(fields, dict):
+            raise ValueError("Deadbands of {} must be a JSON object keyed by field name".format(stream_type))
+        parsed[stream_type] = {name: _parse_deadband(value) for name, value in fields.items()}
+    return parsed
+
+
+class _Plan(object):
+    """ Compressed fields of one schema """
+
+    __slots__ = ['schema', 'values', 'absolute', 'percent']
+
+    def __init__(self, schema, stream_type, deadbands):
+        self.schema = schema
+        default = deadbands.get(_ALL_FIELDS, (0.0, 0.0))
+        unknown = set(deadbands) - set(schema.data_names) - {_ALL_FIELDS}
+        if unknown:
+            _LOGGER.warning("Deadbands of %s name unknown fields %s", stream_type, ', '.join(sorted(unknown)))
+        names = schema.data_names
+        getter = operator.itemgetter(*names)
+        self.values = getter if len(names) > 1 else (lambda reading: (getter(reading),))
+        self.absolute = array.array('d', (deadbands.get(name, default)[0] for name in names))
+        self.percent = array.array('d', (deadbands.get(name, default)[1] for name in names))
+
+
+class _TopicState(object):
+    """ Last ingested reading and swinging-door state of one topic """
+
+    __slots__ = ['archived', 'time', 'upper', 'lower', 'held', 'held_values', 'held_time']
+
+    def __init__(self, values, received):
+        self.archived = values
+        self.time = received
+        self.upper = array.array('d', [float('inf')]) * len(values)
+        self.lower = array.array('d', [float('-inf')]) * len(values)
+        self.held = None
+        self.held_values = None
+        self.held_time = 0.0
+
+    def archive(self, values, received):
+        self.archived = values
+        self.time = received
+        for index in range(len(self.upper)):
+            self.upper[index] = float('inf')
+            self.lower[index] = float('-inf')
+        self.held = None
+
+
+class Compressor(object):
+    """ Decides which readings of the configured stream types are ingested
+
+    Args:
+        deadbands: parsed deadbands, see parse_deadbands()
+        mode: one of MODES
+        heartbeat: seconds after which a reading is ingested even if it is within the deadbands, 0 never
+        max_topics: upper bound of the per topic state, it is cleared when more topics are seen
+    """
+
+    __slots__ = ['deadbands', 'mode', 'heartbeat', 'max_topics', 'streams', '_plans', '_topics']
+
+    def __init__(self, deadbands, mode=DEADBAND, heartbeat=0, max_topics=100000):
+        if mode not in MODES:
+            raise ValueError("Unknown compression mode {}, expected one of {}".format(mode, MODES))
+        self.deadbands = deadbands
+        self.mode = mode
+        self.heartbeat = heartbeat
+        self.max_topics = max_topics
+        self.streams = frozenset(deadbands)
+        self._plans = {}
+        self._topics = {}
+
+    def offer(self, stream_type, schema, topic, data, received):
+        """ Offers a reading of a compressed stream type
+
+        Args:
+            stream_type: stream type of the message topic, the JSON stream type of the schema for JSON payloads
+            schema: schema of the stream type
+            topic: topic of the message
+            data: reading to ingest, the datapoints are in data['readings']
+            received: receive time of the message in seconds of a monotonic clock
+        Returns:
+            the reading to ingest, which in swinging-door mode is an earlier reading of the topic, None if nothing
+            has to be ingested
+        """
+        plan = self._plans.get(stream_type)
+        if plan is None or plan.schema is not schema:
+            plan = self._plans[stream_type] = _Plan(schema, stream_type, self.deadbands[stream_type])
+            # a reloaded schema may have moved the fields
+            for key in [key for key in self._topics if key[0] == stream_type]:
+                del self._topics[key]
+        try:
+            values = array.array('d', plan.values(data['readings']))
+        except (KeyError, TypeError):
+            # dead letters and other readings without numeric schema fields are not compressed
+            return data
+
+        key = (stream_type, topic)
+        state = self._topics.get(key)
+        if state is None:
+            if len(self._topics) >= self.max_topics:
+                self._topics.clear()
+            self._topics[key] = _TopicState(values, received)
+            return data
+        if self.mode == DEADBAND:
+            return self._deadband(plan, state, values, data, received)
+        return self._swinging_door(plan, state, values, data, received)
+
+    def _deadband(self, plan, state, values, data, received):
+        if not self.heartbeat or received - state.time < self.heartbeat:
+            for value, last, absolute, percent in zip(values, state.archived, plan.absolute, plan.percent):
+                if abs(value - last) > absolute + percent * abs(last):
+                    break
+            else:
+                return None
+        state.archive(values, received)
+        return data
+
+    def _swinging_door(self, plan, state, values, data, received):
+        elapsed = received - state.time
+        closed = self.heartbeat and elapsed >= self.heartbeat
+        if not closed and elapsed > 0:
+            closed = self._narrow(plan, state, values, elapsed)
+        if not closed:
+            state.held = data
+            state.held_values = values
+            state.held_time = received
+            return None
+
+        held = state.held
+        if held is None:
+            state.archive(values, received)
+            return data
+        # the held reading is the last one the door still covered, the door is opened again from it
+        state.archive(state.held_values, state.held_time)
+        if received > state.time:
+            self._narrow(plan, state, values, received - state.time)
+        state.held = data
+        state.held_values = values
+        state.held_time = received
+        return held
+
+    @staticmethod
+    def _narrow(plan, state, values, elapsed):
+        """ Narrows the door of every field to a new point, returns True once the door of a field is closed """
+        upper = state.upper
+        lower = state.lower
+        for index, value in enumerate(values):
+            last = state.archived[index]
+            deviation = plan.absolute[index] + plan.percent[index] * abs(last)
+            slope = (value + deviation - last) / elapsed
+            if slope < upper[index]:
+                upper[index] = slope
+            slope = (value - deviation - last) / elapsed
+            if slope > lower[index]:
+                lower[index] = slope
+            if lower[index] > upper[index]:
+                return True
+        return False
+
+    def pending(self):
+        """ Removes and returns (topic, reading) of every reading held back by swinging-door """
+        held = []
+        for (_, topic), state in self._topics.items():
+            if state.held is not None:
+                held.append((topic, state.held))
+                state.held = None
+        return held
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Dead-letter store for payloads the mqtt-readings-binary plugin cannot decode
+
+Undecodable payloads are appended with their topic and receive time to a fixed size, memory-mapped file instead of
+being ingested into Fledge. Once the file is full further dead letters are counted but not stored.
+
+File layout, all integers little-endian:
+    header  magic (8 bytes), capacity, end offset, record count, dropped count (unsigned 64 bit each)
+    record  receive time (double), topic length (unsigned 16 bit), payload length (unsigned 32 bit),
+            topic bytes, payload bytes
+
+Run as a script to list the stored dead letters, replay them to a broker after a schema fix or empty the file:
+    python3 mrb_dead_letter.py list <file>
+    python3 mrb_dead_letter.py replay <file> --host localhost --port 1883
+    python3 mrb_dead_letter.py reset <file>
+"""
+
+import argparse
+import datetime
+import mmap
+import os
+import struct
+import sys
+import time
+
+_MAGIC = b'MRBDLQ01'
+_HEADER = struct.Struct('<8sQQQQ')
+_RECORD = struct.Struct('<dHI')
+
+
+class DeadLetterStore(object):
+    """ Bounded append-only store of undecodable payloads
+
+    Args:
+        path: path of the dead-letter file, created when it does not exist
+        capacity: size in bytes of a new file, an existing file keeps its size
+    """
+
+    __slots__ = ['path', 'capacity', 'end', 'count', 'dropped', '_file', '_map']
+
+    def __init__(self, path, capacity):
+        self.path = path
+        if os.path.exists(path):
+            self._file = open(path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            magic, self.capacity, self.end, self.count, self.dropped = _HEADER.unpack_from(self._map, 0)
+            if magic != _MAGIC or self.capacity != len(self._map):
+                self.close()
+                raise ValueError("{} is not a dead-letter file".format(path))
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.capacity = max(capacity, _HEADER.size + _RECORD.size)
+            self._file = open(path, 'w+b')
+            self._file.truncate(self.capacity)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            self.end = _HEADER.size
+            self.count = 0
+            self.dropped = 0
+            self._write_header()
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, self.capacity, self.end, self.count, self.dropped)
+
+    def append(self, topic, payload, received):
+        """ Stores a payload
+
+        Args:
+            topic: topic the payload was received on
+            payload: raw payload bytes
+            received: receive time in seconds since the epoch
+        Returns:
+            True if the payload was stored, False if the file is full
+        """
+        topic = topic.encode()
+        end = self.end + _RECORD.size + len(topic) + len(payload)
+        if end > self.capacity:
+            self.dropped += 1
+            self._write_header()
+            return False
+
+        offset = self.end
+        _RECORD.pack_into(self._map, offset, received, len(topic), len(payload))
+        offset += _RECORD.size
+        self._map[offset:offset + len(topic)] = topic
+        offset += len(topic)
+        self._map[offset:end] = payload
+
+        # the header is updated last, a record is only visible once it is complete
+        self.end = end
+        self.count += 1
+        self._write_header()
+        return True
+
+    def reset(self):
+        """ Forgets every stored dead letter """
+        self.end = _HEADER.size
+        self.count = 0
+        self.dropped = 0
+        self._write_header()
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_dead_letters(path):
+    """ Yields (receive time, topic, payload) of every dead letter stored in a file
+    """
+    with open(path, 'rb') as dead_letter_file:
+        with mmap.mmap(dead_letter_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, capacity, end, count, dropped = _HEADER.unpack_from(data, 0)
+            if magic != _MAGIC:
+                raise ValueError("{} is not a dead-letter file".format(path))
+            offset = _HEADER.size
+            while offset < end:
+                received, topic_length, payload_length = _RECORD.unpack_from(data, offset)
+                offset += _RECORD.size
+                topic = data[offset:offset + topic_length].decode()
+                offset += topic_length
+                payload = data[offset:offset + payload_length]
+                offset += payload_length
+                yield received, topic, payload
+
+
+def _list(args):
+    count = 0
+    for received, topic, payload in read_dead_letters(args.file):
+        count += 1
+        print("{}  {}  {} bytes  {}".format(datetime.datetime.fromtimestamp(received).isoformat(sep=' '), topic,
+                                            len(payload), payload[:args.bytes].hex()))
+    print("{} dead letters".format(count))
+
+
+def _replay(args):
+    import paho.mqtt.client as mqtt
+
+    client = mqtt.Client()
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    client.connect(args.host, args.port)
+    client.loop_start()
+    count = 0
+    for _, topic, payload in read_dead_letters(args.file):
+        client.publish(topic, payload, qos=args.qos).wait_for_publish()
+        count += 1
+        if args.delay:
+            time.sleep(args.delay)
+    client.disconnect()
+    client.loop_stop()
+    print("{} dead letters replayed to {}:{}".format(count, args.host, args.port))
+
+
+def _reset(args):
+    store = DeadLetterStore(args.file, 0)
+    store.reset()
+    store.close()
+    print("{} emptied".format(args.file))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='List, replay or empty a mqtt-readings-binary dead-letter file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='list the stored dead letters')
+    list_parser.add_argument('file')
+    list_parser.add_argument('--bytes', type=int, default=16, help='number of payload bytes to show in hex')
+    list_parser.set_defaults(func=_list)
+
+    replay_parser = commands.add_parser('replay', help='publish the stored dead letters to their topics again')
+    replay_parser.add_argument('file')
+    replay_parser.add_argument('--host', default='localhost')
+    replay_parser.add_argument('--port', type=int, default=1883)
+    replay_parser.add_argument('--username')
+    replay_parser.add_argument('--password')
+    replay_parser.add_argument('--qos', type=int, default=1, choices=(0, 1, 2))
+    replay_parser.add_argument('--delay', type=float, default=0, help='seconds to wait between two messages')
+    replay_parser.set_defaults(func=_replay)
+
+    reset_parser = commands.add_parser('reset', help='empty the file, stop the south service first')
+    reset_parser.add_argument('file')
+    reset_parser.set_defaults(func=_reset)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Framed multi-record envelope of the mqtt-readings-binary payloads
+
+An envelope lets a device send several records of one schema in a single MQTT message. Layout, little-endian:
+    header   magic b'MR', schema id (unsigned 8 bit), schema version (unsigned 8 bit), record count (unsigned 16 bit)
+    records  record count records packed with the struct_format of the schema
+
+The schema id and version are the schema_id and version of the schema file. A payload exactly one record long is
+a plain record, so devices can switch to envelopes one by one.
+"""
+
+import struct
+
+MAGIC = b'MR'
+HEADER = struct.Struct('<2sBBH')
+
+
+def pack_envelope(schema, records):
+    """ Frames packed records of a schema into one envelope payload
+
+    Args:
+        schema: compiled schema of the records
+        records: list of records packed with the schema struct
+    Returns:
+        envelope payload bytes
+    """
+    return HEADER.pack(MAGIC, schema.schema_id, schema.version, len(records)) + b''.join(records)
+
+
+def is_envelope(payload):
+    return payload[:2] == MAGIC
+
+
+def iter_records(schema, payload):
+    """ Returns an iterator over the unpacked records of an envelope, the records are not copied
+
+    Args:
+        schema: compiled schema of the stream type the envelope was received on
+        payload: envelope payload bytes
+    Raises:
+        ValueError: if the header does not match the schema or the payload size the record count
+    """
+    view = memoryview(payload)
+    magic, schema_id, version, count = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError("Payload is not an envelope")
+    if schema_id != schema.schema_id or version != schema.version:
+        raise ValueError("Envelope schema {} version {} does not match schema {} version {} of {}".format(
+            schema_id, version, schema.schema_id, schema.version, schema.stream_type))
+    if len(view) != HEADER.size + count * schema.size:
+        raise ValueError("Envelope size {} does not match {} records of {} bytes".format(len(view), count,
+                                                                                           schema.size))
+    return schema.struct.iter_unpack(view[HEADER.size:])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Size/time flush window for readings sent to the async ingest layer
+
+Readings are collected into a list which is handed over as one ingest call once it holds max_size readings
+or its oldest reading is max_age seconds old.
+"""
+
+import time
+
+# Upper bounds of the flush size histogram buckets, the last bucket holds every larger flush
+FLUSH_SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000)
+
+
+class ReadingBatcher(object):
+    """ Collects readings and tells when they have to be flushed
+
+    Args:
+        max_size: number of readings that triggers a flush
+        max_age: age in seconds of the oldest pending reading that triggers a flush
+    """
+
+    __slots__ = ['max_size', 'max_age', '_pending', '_first_added', 'flush_count', 'flushed_readings',
+                 'flush_size_buckets', 'flush_latency_total', 'flush_latency_max']
+
+    def __init__(self, max_size, max_age):
+        self.max_size = max(1, max_size)
+        self.max_age = max_age
+        self._pending = []
+        self._first_added = 0.0
+        self.flush_count = 0
+        self.flushed_readings = 0
+        self.flush_size_buckets = [0] * (len(FLUSH_SIZE_BUCKETS) + 1)
+        self.flush_latency_total = 0.0
+        self.flush_latency_max = 0.0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, reading):
+        """ Adds a reading, returns the batch to flush when the flush window is full or None
+        """
+        if not self._pending:
+            self._first_added = time.monotonic()
+        self._pending.append(reading)
+        if len(self._pending) >= self.max_size:
+            return self.take()
+        return None
+
+    def time_to_flush(self):
+        """ Returns the number of seconds until the pending readings are due, None when nothing is pending
+        """
+        if not self._pending:
+            return None
+        return max(0.0, self._first_added + self.max_age - time.monotonic())
+
+    def take(self):
+        """ Removes and returns every pending reading and records the flush size and latency
+        """
+        batch = self._pending
+        if not batch:
+            return batch
+        self._pending = []
+
+        latency = time.monotonic() - self._first_added
+        self.flush_count += 1
+        self.flushed_readings += len(batch)
+        self.flush_latency_total += latency
+        if latency > self.flush_latency_max:
+            self.flush_latency_max = latency
+        for index, upper in enumerate(FLUSH_SIZE_BUCKETS):
+            if len(batch) <= upper:
+                self.flush_size_buckets[index] += 1
+                break
+        else:
+            self.flush_size_buckets[-1] += 1
+        return batch
+
+    def stats(self):
+        """ Returns the flush counters as a dictionary
+        """
+        buckets = {'<={}'.format(upper): count for upper, count in zip(FLUSH_SIZE_BUCKETS, self.flush_size_buckets)}
+        buckets['>{}'.format(FLUSH_SIZE_BUCKETS[-1])] = self.flush_size_buckets[-1]
+        return {
+            'flushes': self.flush_count,
+            'readings': self.flushed_readings,
+            'avgFlushSize': self.flushed_readings / self.flush_count if self.flush_count else 0,
+            'avgFlushLatency': self.flush_latency_total / self.flush_count if self.flush_count else 0,
+            'maxFlushLatency': self.flush_latency_max,
+            'flushSizes': buckets
+        }
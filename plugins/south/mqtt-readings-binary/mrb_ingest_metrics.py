@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Ingest counters and latency histograms of the mqtt-readings-binary plugin
+
+Counters are kept per stream type and device. They are created by the network thread when a topic is first
+routed and only updated by the ingest thread, so they need no locking. A snapshot of them can be written to a
+local JSON metrics file and summarised into a Fledge reading.
+"""
+
+import bisect
+import json
+import os
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket holds every slower sample
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+# Upper bounds in seconds of the lag histogram buckets of the latency tracing, the device RTC has a resolution of
+# one second and the ingest stages may back up for minutes
+LAG_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _bucket_label(seconds):
+    if seconds < 0.001:
+        return '<={}us'.format(int(seconds * 1000000))
+    if seconds < 1:
+        return '<={}ms'.format(int(seconds * 1000))
+    return '<={}s'.format(int(seconds))
+
+
+def _bucket_labels(buckets):
+    return tuple(_bucket_label(upper) for upper in buckets) + ('>{}'.format(_bucket_label(buckets[-1])[2:]),)
+
+
+_BUCKET_LABELS = {LATENCY_BUCKETS: _bucket_labels(LATENCY_BUCKETS), LAG_BUCKETS: _bucket_labels(LAG_BUCKETS)}
+
+
+class LatencyHistogram(object):
+    """ Fixed bucket latency histogram
+
+    Args:
+        buckets: upper bounds in seconds of the buckets, LATENCY_BUCKETS or LAG_BUCKETS
+    """
+
+    __slots__ = ['buckets', 'counts', 'count', 'total', 'max']
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, count=1):
+        """ Records count samples of the given latency """
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += count
+        self.count += count
+        self.total += seconds * count
+        if seconds > self.max:
+            self.max = seconds
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': {label: count for label, count in zip(_BUCKET_LABELS[self.buckets], self.counts) if count}
+        }
+
+
+class StageLags(object):
+    """ Lag histograms of the stages a reading of one device passes through, see mrb_latency_trace.py
+
+    device  from the RTC time in the payload to the MQTT receive
+    queue   from the MQTT receive to the end of decoding, mostly the wait in the ingest queue
+    batch   from the end of decoding to the ingest call, mostly the wait in the ingest batch
+    """
+
+    __slots__ = ['device', 'queue', 'batch']
+
+    def __init__(self):
+        self.device = LatencyHistogram(LAG_BUCKETS)
+        self.queue = LatencyHistogram(LAG_BUCKETS)
+        self.batch = LatencyHistogram(LAG_BUCKETS)
+
+    def to_dict(self):
+        return {
+            'device': self.device.to_dict(),
+            'queue': self.queue.to_dict(),
+            'batch': self.batch.to_dict()
+        }
+
+
+class StreamCounters(object):
+    """ Counters of one stream type of one device """
+
+    __slots__ = ['messages', 'bytes', 'envelopes', 'envelope_records', 'decode_failures', 'size_mismatches',
+                 'suppressed', 'readings', 'ingest_failures', 'decode_latency', 'lags']
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.envelopes = 0
+        self.envelope_records = 0
+        self.decode_failures = 0
+        self.size_mismatches = 0
+        self.suppressed = 0
+        self.readings = 0
+        # messages lost to an error outside the decoding, e.g. in compression or the ingest call
+        self.ingest_failures = 0
+        self.decode_latency = LatencyHistogram()
+        # only created with latency tracing enabled
+        self.lags = None
+
+    @property
+    def records(self):
+        """ Number of records received, an envelope counts as one message but holds several records """
+        return self.messages - self.envelopes + self.envelope_records
+
+    def to_dict(self):
+        counters = {
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'envelopes': self.envelopes,
+            'envelopeRecords': self.envelope_records,
+            'decodeFailures': self.decode_failures,
+            'sizeMismatches': self.size_mismatches,
+            'suppressed': self.suppressed,
+            'readings': self.readings,
+            'ingestFailures': self.ingest_failures,
+            'compressionRatio': self.records / self.readings if self.readings else 0,
+            'decodeLatency': self.decode_latency.to_dict()
+        }
+        if self.lags is not None:
+            counters['lag'] = self.lags.to_dict()
+        return counters
+
+
+class IngestMetrics(object):
+    """ Counters of every stream type and device plus the latency of the ingest calls """
+
+    __slots__ = ['streams', 'ingest_calls', 'ingest_latency', 'started']
+
+    def __init__(self):
+        self.streams = {}
+        self.ingest_calls = 0
+        self.ingest_latency = LatencyHistogram()
+        self.started = time.time()
+
+    def counters(self, stream_type, device):
+        """ Returns the counters of a stream type of a device, creating them on first use """
+        key = (stream_type, device)
+        counters = self.streams.get(key)
+        if counters is None:
+            counters = self.streams[key] = StreamCounters()
+        return counters
+
+    def add_ingest(self, seconds):
+        self.ingest_calls += 1
+        self.ingest_latency.add(seconds)
+
+    def totals(self):
+        """ Returns the counters summed per stream type, e.g. {'adstop_messages': 10, ...}
+
+        The compression ratio of a stream type is the number of received records per ingested reading.
+        """
+        totals = {}
+        stream_types = set()
+        for (stream_type, _), counters in list(self.streams.items()):
+            stream_types.add(stream_type)
+            for name in ('messages', 'bytes', 'envelopes', 'envelope_records', 'decode_failures', 'size_mismatches',
+                         'suppressed', 'readings', 'ingest_failures'):
+                key = '{}_{}'.format(stream_type, name)
+                totals[key] = totals.get(key, 0) + getattr(counters, name)
+        for stream_type in stream_types:
+            readings = totals['{}_readings'.format(stream_type)]
+            records = (totals['{}_messages'.format(stream_type)] - totals['{}_envelopes'.format(stream_type)] +
+                       totals['{}_envelope_records'.format(stream_type)])
+            totals['{}_compression_ratio'.format(stream_type)] = records / readings if readings else 0
+        totals['ingest_calls'] = self.ingest_calls
+        return totals
+
+    def snapshot(self, **extra):
+        """ Returns every counter as a JSON serialisable dictionary, extra keyword arguments are added as they are """
+        streams = {}
+        for (stream_type, device), counters in list(self.streams.items()):
+            streams.setdefault(stream_type, {})[device] = counters.to_dict()
+        snapshot = {
+            'since': self.started,
+            'time': time.time(),
+            'streams': streams,
+            'ingest': {
+                'calls': self.ingest_calls,
+                'latency': self.ingest_latency.to_dict()
+            }
+        }
+        snapshot.update(extra)
+        return snapshot
+
+
+def write_snapshot(path, snapshot):
+    """ Replaces the metrics file with the snapshot, readers never see a partially written file """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as metrics_file:
+        json.dump(snapshot, metrics_file, indent=2)
+    os.replace(temp_path, path)
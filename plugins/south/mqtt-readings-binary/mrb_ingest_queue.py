@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Bounded hand-over queue between the paho network thread and the ingest thread
+
+When the queue is full the overflow policy decides what happens to a new message:
+    block        the paho thread waits for free space, which pushes back on the broker
+    drop-oldest  the oldest queued message is discarded to make room
+    drop-newest  the new message is discarded
+"""
+
+import collections
+import threading
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class BoundedQueue(object):
+    """ Thread safe FIFO with a fixed capacity and an overflow policy
+
+    Args:
+        maxsize: maximum number of queued items
+        policy: one of POLICIES
+    """
+
+    __slots__ = ['maxsize', 'policy', '_items', '_lock', '_not_empty', '_not_full', '_closed', 'put_count',
+                 'dropped_oldest', 'dropped_newest', 'max_depth']
+
+    def __init__(self, maxsize, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue overflow policy {}, expected one of {}".format(policy, POLICIES))
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+        self.put_count = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    @property
+    def dropped(self):
+        return self.dropped_oldest + self.dropped_newest
+
+    def put(self, item):
+        """ Queues an item according to the overflow policy
+
+        Returns:
+            False if the item was discarded, because of the drop-newest policy or a closed queue, True otherwise
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == BLOCK:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+                elif self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped_oldest += 1
+                else:
+                    self.dropped_newest += 1
+                    return False
+            self._items.append(item)
+            self.put_count += 1
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            self._not_empty.notify()
+            return True
+
+    def get_many(self, max_items, timeout=None):
+        """ Removes and returns up to max_items queued items
+
+        Waits up to timeout seconds, or until the queue is closed when timeout is None, for a first item.
+
+        Returns:
+            list of items, empty when the timeout expired, None when the queue is closed and drained
+        """
+        with self._lock:
+            if not self._items and not self._closed:
+                self._not_empty.wait(timeout)
+            if not self._items:
+                return None if self._closed else []
+            count = min(max_items, len(self._items))
+            items = [self._items.popleft() for _ in range(count)]
+            self._not_full.notify_all()
+            return items
+
+    def close(self):
+        """ Rejects further items and wakes up every waiting thread, queued items can still be drained
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def stats(self):
+        """ Returns the queue counters as a dictionary
+        """
+        return {
+            'depth': len(self._items),
+            'maxDepth': self.max_depth,
+            'queued': self.put_count,
+            'droppedOldest': self.dropped_oldest,
+            'droppedNewest': self.dropped_newest
+        }
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Decoding of the JSON payloads published on the *data topics, e.g. <device>/adsdata
+
+ADS and PDS devices publish a flat object of field values and a "timestamp", DDS devices publish only the channels
+that changed, each as {"state": s, "timestamp": t}. The payload is parsed with orjson when it is installed and with
+the json module otherwise.
+
+The keys of a payload are checked against the schema once per distinct set of keys: the plan of a key set lists the
+nested channel objects to flatten, and field names the schema does not know are reported once per stream type.
+The parsed object itself becomes the reading, channel objects are replaced by their state in place and the
+timestamp of the first channel becomes the reading timestamp when the payload has none of its own.
+"""
+
+import logging
+
+from fledge.common import logger
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+_LOGGER = logger.setup(__name__, level=logging.INFO)
+
+# Upper bound of the cached key sets of a stream type, DDS devices send any subset of their channels
+_MAX_KEY_SETS = 4096
+
+# Keys of a reading that are not schema fields
+_RESERVED_KEYS = frozenset(('timestamp', 'topic'))
+
+
+class JsonDecoder(object):
+    """ Decodes JSON payloads into reading datapoints with a plan cached per schema and key set """
+
+    __slots__ = ['_plans', '_reported']
+
+    def __init__(self):
+        self._plans = {}
+        self._reported = {}
+
+    def decode(self, schema, stream_type, payload, topic):
+        """ Decodes one JSON payload
+
+        Args:
+            schema: schema of the stream
+            stream_type: JSON stream type of the message topic
+            payload: payload bytes
+            topic: topic of the message
+        Returns:
+            reading datapoints
+        Raises:
+            ValueError: if the payload is not a JSON object or its timestamp is not a string
+            KeyError, TypeError: if a channel object has no state
+        """
+        reading = loads(payload)
+        if reading.__class__ is not dict:
+            raise ValueError("JSON payload is not an object")
+        cached = self._plans.get(stream_type)
+        if cached is None or cached[0] is not schema:
+            # a reloaded schema may name other fields
+            cached = self._plans[stream_type] = (schema, {})
+        plans = cached[1]
+        keys = tuple(reading)
+        plan = plans.get(keys)
+        if plan is None:
+            if len(plans) >= _MAX_KEY_SETS:
+                plans.clear()
+            plan = plans[keys] = self._plan(schema, stream_type, reading)
+
+        nested, timestamp_key = plan
+        if timestamp_key is not None:
+            reading['timestamp'] = reading[timestamp_key]['timestamp']
+        for key in nested:
+            reading[key] = reading[key]['state']
+        if 'timestamp' in reading and reading['timestamp'].__class__ is not str:
+            # the RTC clock only takes "YYYY-MM-DD HH:MM:SS" times
+            raise ValueError("JSON payload timestamp {!r} is not a string".format(reading['timestamp']))
+        reading['topic'] = topic
+        return reading
+
+    def _plan(self, schema, stream_type, reading):
+        """ Returns (keys of the channel objects, key of the channel holding the timestamp or None) of a key set """
+        nested = tuple(key for key, value in reading.items() if value.__class__ is dict and 'state' in value)
+        timestamp_key = nested[0] if nested and 'timestamp' not in reading else None
+
+        reported = self._reported.setdefault(stream_type, set())
+        unknown = set(reading) - set(schema.data_names) - _RESERVED_KEYS - reported
+        if unknown:
+            reported.update(unknown)
+            _LOGGER.warning("JSON payloads of %s carry fields %s that schema %s does not name, they are ingested "
+                            "as they are", stream_type, ', '.join(sorted(unknown)), schema.stream_type)
+        return nested, timestamp_key
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" End-to-end latency tracing of the readings of the mqtt-readings-binary plugin
+
+Every reading is stamped when it is saved with its device counters, the MQTT receive time, the end of decoding and
+the RTC time of the payload. The stamp travels with the reading through compression and the ingest batch and is
+removed again when the batch is handed to Fledge, where the lags of the stages are added to the per device
+StageLags histograms of the ingest metrics.
+
+One in sample_interval readings is also traced: a "trace" datapoint holding the stage times as a JSON object,
+in seconds since the epoch, is added to the reading and the same JSON is written as a line to the trace log, or to
+the plugin log when no trace file is configured. Filters further down the pipeline, e.g. calculate_ads_values, add
+their own stage to the trace datapoint, so the stored reading carries the whole path:
+    {"asset": ..., "topic": ..., "rtc": ..., "received": ..., "decoded": ..., "submitted": ..., "filtered": ...}
+"""
+
+import json
+import logging
+import os
+import time
+
+from fledge.common import logger
+
+from mrb_ingest_metrics import StageLags
+
+_LOGGER = logger.setup(__name__, level=logging.INFO)
+
+# Key of the stamp in the reading dictionary, it never reaches Fledge
+_STAMP = '_trace'
+
+
+class LatencyTracer(object):
+    """ Stamps readings on save and records their stage lags on submit
+
+    Args:
+        clock: RtcClock converting the RTC time of the payloads
+        sample_interval: one in sample_interval readings is traced, 0 traces none
+        path: path of the trace log the traces are appended to as JSON lines, empty for the plugin log
+    """
+
+    __slots__ = ['clock', 'sample_interval', 'path', 'traced', '_countdown', '_file']
+
+    def __init__(self, clock, sample_interval, path=''):
+        self.clock = clock
+        self.sample_interval = sample_interval
+        self.path = path
+        self.traced = 0
+        self._countdown = sample_interval
+        self._file = None
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, 'a', buffering=1)
+
+    def stamp(self, data, counters, received, rtc_time):
+        """ Stamps a reading that is about to be queued for ingest
+
+        Args:
+            data: reading to ingest, the datapoints are in data['readings']
+            counters: counters of the stream type and device of the reading
+            received: receive time of the message in seconds of the monotonic clock
+            rtc_time: "YYYY-MM-DD HH:MM:SS" RTC time of the payload, None if it has none
+        """
+        rtc = self.clock.epoch(rtc_time) if rtc_time.__class__ is str else None
+        data[_STAMP] = (counters, received, time.monotonic(), rtc)
+
+    def submitted(self, batch):
+        """ Removes the stamps of a batch handed to Fledge and records the stage lags of its readings """
+        now = time.monotonic()
+        # the monotonic receive times are turned into wall clock times for the RTC lag and the traces
+        wall = time.time() - now
+        for data in batch:
+            stamp = data.pop(_STAMP, None)
+            if stamp is None:
+                continue
+            counters, received, decoded, rtc = stamp
+            lags = counters.lags
+            if lags is None:
+                lags = counters.lags = StageLags()
+            if rtc is not None:
+                lags.device.add(received + wall - rtc)
+            lags.queue.add(decoded - received)
+            lags.batch.add(now - decoded)
+            if self.sample_interval:
+                self._countdown -= 1
+                if not self._countdown:
+                    self._countdown = self.sample_interval
+                    self._trace(data, rtc, received + wall, decoded + wall, now + wall)
+
+    def _trace(self, data, rtc, received, decoded, submitted):
+        readings = data['readings']
+        trace = json.dumps({'asset': data['asset'], 'topic': readings.get('topic'), 'rtc': rtc,
+                            'received': received, 'decoded': decoded, 'submitted': submitted})
+        readings['trace'] = trace
+        self.traced += 1
+        if self._file is not None:
+            self._file.write(trace + '\n')
+        else:
+            _LOGGER.info("Reading trace: %s", trace)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Report-by-exception for status streams such as the DDS digital channels
+
+The digital states of a device rarely change, so a reading is only ingested when one of its data values differs
+from the last ingested reading of the same topic, i.e. of the same device and stream. A heartbeat still lets an
+unchanged reading through once the last one of the topic is heartbeat seconds old, so a silent device can be told
+apart from an unchanged one.
+"""
+
+
+class ReportByException(object):
+    """ Last reported state and report time per topic
+
+    Args:
+        heartbeat: seconds after which an unchanged state is reported again, 0 never reports it again
+        max_topics: upper bound of the state cache, it is cleared when more topics are seen
+    """
+
+    __slots__ = ['heartbeat', 'max_topics', '_last']
+
+    def __init__(self, heartbeat, max_topics):
+        self.heartbeat = heartbeat
+        self.max_topics = max_topics
+        self._last = {}
+
+    def report(self, topic, state, received):
+        """ Tells whether the state of a topic has to be reported and remembers it if so
+
+        Args:
+            topic: topic of the message
+            state: tuple of the data values of the message
+            received: receive time of the message in seconds of a monotonic clock
+        Returns:
+            True if the state changed, is the first one of the topic or the heartbeat expired
+        """
+        last = self._last.get(topic)
+        if last is not None and last[0] == state and (not self.heartbeat or received - last[1] < self.heartbeat):
+            return False
+        if last is None and len(self._last) >= self.max_topics:
+            self._last.clear()
+        self._last[topic] = (state, received)
+        return True
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Formatting of the device RTC time carried by every binary record
+
+The records hold the RTC as separate seconds, minutes, hours, weekday, date, month and year fields. The date
+part only changes once a day, so the "YYYY-MM-DD " prefix is built and validated once per day and the time of
+day is joined from precomputed two digit strings instead of being formatted for every message.
+"""
+
+import calendar
+import datetime
+import re
+
+# "00" .. "99"
+_TWO_DIGITS = tuple('{:02d}'.format(value) for value in range(100))
+
+# Upper bound of the per day caches, they are cleared when records span more days
+_MAX_DAYS = 400
+
+_UTC_OFFSET = re.compile(r'^[+-]\d\d:\d\d$')
+
+
+# "YYYY-MM-DD " prefixes keyed by (year, month, date)
+_prefixes = {}
+
+
+def format_rtc(seconds, minutes, hours, date, month, year):
+    """ Returns the RTC time as "YYYY-MM-DD HH:MM:SS", a two digit year counts from 2000
+    """
+    if year <= 99:
+        year += 2000
+    key = (year, month, date)
+    prefix = _prefixes.get(key)
+    if prefix is None:
+        if len(_prefixes) >= _MAX_DAYS:
+            _prefixes.clear()
+        prefix = _prefixes[key] = f"{year}-{month:02d}-{date:02d} "
+    try:
+        return prefix + _TWO_DIGITS[hours] + ':' + _TWO_DIGITS[minutes] + ':' + _TWO_DIGITS[seconds]
+    except IndexError:
+        return f"{prefix}{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+class RtcClock(object):
+    """ Turns "YYYY-MM-DD HH:MM:SS" RTC times into Fledge reading timestamps
+
+    Args:
+        utc_offset: offset of the device clock to UTC, e.g. +05:30
+    """
+
+    __slots__ = ['utc_offset', '_valid_days', '_suffix', '_offset_seconds', '_midnights']
+
+    def __init__(self, utc_offset='+00:00'):
+        if not _UTC_OFFSET.match(utc_offset):
+            raise ValueError("Invalid UTC offset {}, expected +HH:MM or -HH:MM".format(utc_offset))
+        self.utc_offset = utc_offset
+        self._valid_days = {}
+        self._suffix = '.000000' + utc_offset
+        self._offset_seconds = (int(utc_offset[1:3]) * 3600 + int(utc_offset[4:6]) * 60) * (
+            -1 if utc_offset[0] == '-' else 1)
+        self._midnights = {}
+
+    def timestamp(self, rtc_time):
+        """ Converts a "YYYY-MM-DD HH:MM:SS" RTC time into a Fledge reading timestamp
+
+        Returns:
+            timestamp string with microseconds and UTC offset, None if the RTC time is not a valid date and time
+        """
+        if len(rtc_time) != 19 or rtc_time[11:13] > '23' or rtc_time[14:16] > '59' or rtc_time[17:19] > '59':
+            return None
+        day = rtc_time[:10]
+        valid = self._valid_days.get(day)
+        if valid is None:
+            if len(self._valid_days) >= _MAX_DAYS:
+                self._valid_days.clear()
+            try:
+                datetime.datetime.strptime(rtc_time, '%Y-%m-%d %H:%M:%S')
+                valid = True
+            except ValueError:
+                valid = False
+            self._valid_days[day] = valid
+        return rtc_time + self._suffix if valid else None
+
+    def epoch(self, rtc_time):
+        """ Converts a "YYYY-MM-DD HH:MM:SS" RTC time into seconds since the epoch
+
+        Returns:
+            seconds since the epoch, None if the RTC time is not a valid date and time
+        """
+        if len(rtc_time) != 19 or rtc_time[11:13] > '23' or rtc_time[14:16] > '59' or rtc_time[17:19] > '59':
+            return None
+        day = rtc_time[:10]
+        midnight = self._midnights.get(day)
+        if midnight is None:
+            if len(self._midnights) >= _MAX_DAYS:
+                self._midnights.clear()
+            try:
+                midnight = calendar.timegm(datetime.datetime.strptime(day, '%Y-%m-%d').timetuple()) - \
+                    self._offset_seconds
+            except ValueError:
+                midnight = False
+            self._midnights[day] = midnight
+        if midnight is False:
+            return None
+        try:
+            return midnight + int(rtc_time[11:13]) * 3600 + int(rtc_time[14:16]) * 60 + int(rtc_time[17:19])
+        except ValueError:
+            return None
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Schema registry for the mqtt-readings-binary decoders
+
+Every stream type is described by a JSON file in the plugin directory holding the stream_type (the topic suffix,
+e.g. adstop), the struct_format and the field_names of the packed record, plus the schema_id and version that
+identify the schema in envelope headers. Adding a stream type only needs a new schema file. The registry loads
+those files once, keeps a precompiled struct.Struct per stream type and only reloads a file when its modification
+time changes, so the message path never touches the disk.
+
+For every schema a decode function is generated once, so decoding a message does no generic looping over the
+fields in Python. Narrow records are unpacked into locals and returned as a dict display with the field names as
+constant keys, wide records are named by one dict(zip()) over the interned field names, which is faster once a
+record has more than a few dozen fields. The device
+records end with the RTC (seconds, minutes, hours, weekday, date, month, year) and the IsNlf flag; when the
+struct_format ends with that trailer the decoder adds the formatted RTC as "timestamp" and IsNlf as a boolean.
+Every reading also carries the topic it was received on.
+
+A schema may also name a json_stream_type, the topic suffix its devices publish JSON payloads on (e.g. adsdata),
+see mrb_json_payload.py. The registry resolves such a stream type to the schema as well.
+"""
+
+import json
+import logging
+import os
+import re
+import struct
+import sys
+import time
+
+from fledge.common import logger
+
+from mrb_rtc_time import format_rtc
+
+_LOGGER = logger.setup(__name__, level=logging.INFO)
+
+# Struct codes of the RTC and IsNlf trailer every device record ends with
+_TRAILER_CODES = ('B', 'B', 'B', 'B', 'B', 'B', 'H', '?')
+_TRAILER_NAMES = frozenset(('seconds', 'minutes', 'hours', 'weekday', 'date', 'month', 'year', 'IsNlf'))
+
+# Widest record decoded into a dict display, wider ones use dict(zip())
+_MAX_DISPLAY_FIELDS = 32
+
+_FORMAT_ITEM = re.compile(r'(\d*)([xcbB?hHiIlLqQnNefdspP])')
+
+
+def _value_codes(struct_format):
+    """ Returns the struct code of every value unpacked by a struct format, e.g. '<2fH' gives ('f', 'f', 'H') """
+    codes = []
+    for count, code in _FORMAT_ITEM.findall(struct_format.lstrip('@=<>!')):
+        if code == 'x':
+            continue
+        # a counted string is a single value
+        codes.extend(code * (1 if code in 'sp' else int(count or 1)))
+    return tuple(codes)
+
+
+def record_layout(struct_format):
+    """ Returns the number of values a struct format unpacks and how many of them are data values
+
+    The data values are the values in front of the RTC and IsNlf trailer, every value when the record has no trailer.
+    """
+    codes = _value_codes(struct_format)
+    if codes[-len(_TRAILER_CODES):] == _TRAILER_CODES:
+        return len(codes), len(codes) - len(_TRAILER_CODES)
+    return len(codes), len(codes)
+
+
+def data_field_names(stream_type, struct_format, field_names):
+    """ Returns the names of the data values of a record, the values in front of the RTC and IsNlf trailer
+
+    Data fields are named in record order. When the schema names fewer data fields than the record holds the
+    unnamed values are left out.
+    """
+    count, data_count = record_layout(struct_format)
+    names = tuple(sys.intern(name) for name in field_names if data_count == count or name not in _TRAILER_NAMES)
+    if len(names) != data_count:
+        _LOGGER.warning("Schema %s names %s data fields but its struct_format holds %s data values, unnamed "
+                        "values are dropped", stream_type, len(names), data_count)
+    return names[:data_count]
+
+
+def compile_decoder(stream_type, struct_format, data_names):
+    """ Generates the decode function of a schema
+
+    The RTC and IsNlf are always taken from the record trailer whether the schema names them or not.
+
+    Args:
+        stream_type: stream type of the schema, used in the generated function name
+        struct_format: struct format of the packed record
+        data_names: names of the data values, see data_field_names()
+    Returns:
+        function(values, topic) returning the datapoints of one unpacked record
+    """
+    count, data_count = record_layout(struct_format)
+    has_trailer = data_count != count
+    names = data_names
+    function_name = 'decode_' + re.sub(r'\W', '_', stream_type)
+    lines = ['def {}(values, topic):'.format(function_name)]
+    if len(names) <= _MAX_DISPLAY_FIELDS:
+        lines.append('    ({},) = values'.format(', '.join('v{}'.format(index) for index in range(count))))
+        value = 'v{}'.format
+        items = ['{!r}: v{}'.format(name, index) for index, name in enumerate(names)]
+    else:
+        value = 'values[{}]'.format
+        lines.append('    reading = dict(zip(_names, values))')
+        items = []
+    if has_trailer:
+        # seconds, minutes, hours, (weekday), date, month, year, IsNlf
+        rtc = data_count
+        items.append("'timestamp': format_rtc({}, {}, {}, {}, {}, {})".format(
+            value(rtc), value(rtc + 1), value(rtc + 2), value(rtc + 4), value(rtc + 5), value(rtc + 6)))
+        items.append("'IsNlf': bool({})".format(value(rtc + 7)))
+    items.append("'topic': topic")
+    if len(names) <= _MAX_DISPLAY_FIELDS:
+        lines.append('    return {{{}}}'.format(', '.join(items)))
+    else:
+        lines.append('    reading.update({{{}}})'.format(', '.join(items)))
+        lines.append('    return reading')
+
+    source = '\n'.join(lines) + '\n'
+    namespace = {'format_rtc': format_rtc, '_names': names}
+    exec(compile(source, '<schema {}>'.format(stream_type), 'exec'), namespace)
+    return namespace[function_name]
+
+
+class Schema(object):
+    """ Compiled form of one schema file"""
+
+    __slots__ = ['stream_type', 'path', 'mtime', 'struct', 'size', 'field_names', 'data_count', 'data_names',
+                 'decode', 'schema_id', 'version', 'json_stream_type']
+
+    def __init__(self, stream_type, path, mtime, struct_format, field_names, schema_id=None, version=1,
+                 json_stream_type=None):
+        self.stream_type = stream_type
+        self.schema_id = schema_id
+        self.version = version
+        self.json_stream_type = json_stream_type
+        self.path = path
+        self.mtime = mtime
+        self.struct = struct.Struct(struct_format)
+        self.size = self.struct.size
+        self.field_names = tuple(sys.intern(name) for name in field_names)
+        self.data_count = record_layout(struct_format)[1]
+        self.data_names = data_field_names(stream_type, struct_format, self.field_names)
+        self.decode = compile_decoder(stream_type, struct_format, self.data_names)
+
+    @classmethod
+    def from_file(cls, path):
+        """ Loads a schema file
+
+        Returns:
+            the compiled schema, None if the file is not a schema file
+        """
+        mtime = os.stat(path).st_mtime_ns
+        with open(path, 'r') as json_file:
+            schema_data = json.load(json_file)
+        if not isinstance(schema_data, dict) or 'stream_type' not in schema_data:
+            return None
+        return cls(schema_data['stream_type'], path, mtime, schema_data['struct_format'], schema_data['field_names'],
+                   schema_data.get('schema_id'), schema_data.get('version', 1), schema_data.get('json_stream_type'))
+
+
+class SchemaRegistry(object):
+    """ Holds the compiled schema of every stream type and reloads changed schema files
+
+    Args:
+        schema_dir: directory holding the schema JSON files
+        check_interval: minimum number of seconds between two checks of the schema files
+    """
+
+    __slots__ = ['schema_dir', 'check_interval', 'reload_count', '_schemas', '_json_streams', '_ignored',
+                 '_next_check']
+
+    def __init__(self, schema_dir, check_interval=10):
+        self.schema_dir = schema_dir
+        self.check_interval = check_interval
+        self.reload_count = 0
+        self._schemas = {}
+        self._ignored = {}
+        for path in self._schema_paths():
+            schema = Schema.from_file(path)
+            if schema is None:
+                self._ignored[path] = os.stat(path).st_mtime_ns
+            else:
+                self._schemas[schema.stream_type] = schema
+        self._json_streams = {}
+        self._index_json_streams()
+        self._next_check = time.monotonic() + check_interval
+
+    def __contains__(self, stream_type):
+        return stream_type in self._schemas or stream_type in self._json_streams
+
+    @property
+    def stream_types(self):
+        return sorted(self._schemas)
+
+    @property
+    def json_stream_types(self):
+        return sorted(self._json_streams)
+
+    def _index_json_streams(self):
+        self._json_streams = {schema.json_stream_type: schema.stream_type for schema in self._schemas.values()
+                              if schema.json_stream_type and schema.json_stream_type not in self._schemas}
+
+    def _schema_paths(self):
+        return sorted(os.path.join(self.schema_dir, file_name) for file_name in os.listdir(self.schema_dir)
+                      if file_name.endswith('.json'))
+
+    def get(self, stream_type):
+        """ Returns the compiled schema of a stream type, reloading changed schema files at most once per check_interval
+
+        The schema of a JSON stream type is the schema naming it as its json_stream_type.
+        """
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.refresh()
+        try:
+            return self._schemas[stream_type]
+        except KeyError:
+            return self._schemas[self._json_streams[stream_type]]
+
+    def refresh(self):
+        """ Reloads every schema file whose modification time differs from the loaded one and loads new schema files
+
+        A schema file that cannot be read or compiled keeps its previous compiled schema in use.
+        """
+        loaded = {schema.path: schema for schema in self._schemas.values()}
+        try:
+            paths = self._schema_paths()
+        except OSError as ex:
+            _LOGGER.error("Failed to list schema directory %s: %s", self.schema_dir, str(ex))
+            paths = list(loaded)
+        for path in paths:
+            previous = loaded.get(path)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                if mtime == (previous.mtime if previous is not None else self._ignored.get(path)):
+                    continue
+                schema = Schema.from_file(path)
+                if schema is None:
+                    if previous is not None:
+                        raise ValueError("stream_type is missing")
+                    # other JSON files are only read again when they change
+                    self._ignored[path] = mtime
+                    continue
+            except (OSError, ValueError, KeyError, TypeError, struct.error) as ex:
+                _LOGGER.error("Failed to reload schema %s, keeping the previous one: %s", path, str(ex))
+                continue
+            if previous is not None and previous.stream_type != schema.stream_type:
+                del self._schemas[previous.stream_type]
+            self._schemas[schema.stream_type] = schema
+            self._ignored.pop(path, None)
+            self.reload_count += 1
+            self._index_json_streams()
+            _LOGGER.info("Reloaded schema %s for %s (reload count: %s)", path, schema.stream_type, self.reload_count)
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# FLEDGE_BEGIN
+# See: http://fledge-iot.readthedocs.io/
+# FLEDGE_END
+
+""" Disk-backed store-and-forward buffer of decoded readings
+
+When Fledge ingest falls behind the plugin appends its reading batches to a fixed size, memory-mapped ring file
+instead of waiting for the ingest calls, and drains the file in large batches once ingest has recovered. The file
+outlives the service, readings still spilled at shutdown are drained after the next start.
+
+File layout, all integers little-endian:
+    header  magic (8 bytes), capacity, head offset, tail offset, record count, pending readings, spilled readings,
+            drained readings, dropped readings (unsigned 64 bit each)
+    record  body length (unsigned 32 bit), reading count (unsigned 32 bit), body: the readings as a JSON array
+
+Records are appended at the tail and taken from the head. A record that does not fit in front of the end of the
+file is written at the start of the data area, behind a wrap marker when there is room for one. When the file is
+full a new batch is dropped and counted.
+"""
+
+import mmap
+import os
+import struct
+import time
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    import json
+
+    def _dumps(readings):
+        return json.dumps(readings, separators=(',', ':')).encode()
+
+    _loads = json.loads
+
+_MAGIC = b'MRBSPL01'
+_HEADER = struct.Struct('<8s8Q')
+_RECORD = struct.Struct('<II')
+
+# Body length of the marker telling the reader to continue at the start of the data area
+_WRAP = 0xFFFFFFFF
+
+
+class SpillBuffer(object):
+    """ Bounded FIFO ring of reading batches in a memory-mapped file
+
+    Args:
+        path: path of the spill file, created when it does not exist
+        capacity: size in bytes of a new file, an existing file keeps its size and its pending readings
+    """
+
+    __slots__ = ['path', 'capacity', 'head', 'tail', 'records', 'pending', 'spilled', 'drained', 'dropped',
+                 'spill_rate', 'drain_rate', '_rate_time', '_rate_spilled', '_rate_drained', '_file', '_map']
+
+    def __init__(self, path, capacity):
+        self.path = path
+        if os.path.exists(path):
+            self._file = open(path, 'r+b')
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            (magic, self.capacity, self.head, self.tail, self.records, self.pending, self.spilled, self.drained,
+             self.dropped) = _HEADER.unpack_from(self._map, 0)
+            if magic != _MAGIC or self.capacity != len(self._map):
+                self.close()
+                raise ValueError("{} is not a spill file".format(path))
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.capacity = max(capacity, _HEADER.size + 2 * _RECORD.size)
+            self._file = open(path, 'w+b')
+            self._file.truncate(self.capacity)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+            self.head = self.tail = _HEADER.size
+            self.records = 0
+            self.pending = 0
+            self.spilled = 0
+            self.drained = 0
+            self.dropped = 0
+            self._write_header()
+        self.spill_rate = 0.0
+        self.drain_rate = 0.0
+        self._rate_time = time.monotonic()
+        self._rate_spilled = self.spilled
+        self._rate_drained = self.drained
+
+    def __len__(self):
+        return self.pending
+
+    def _write_header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, self.capacity, self.head, self.tail, self.records, self.pending,
+                          self.spilled, self.drained, self.dropped)
+
+    def append(self, readings):
+        """ Appends a batch of readings
+
+        Args:
+            readings: list of readings, each a dictionary with asset, timestamp and readings
+        Returns:
+            True if the batch was stored, False if the file is full
+        """
+        body = _dumps(readings)
+        size = _RECORD.size + len(body)
+        offset = self.tail
+        if self.records and offset <= self.head:
+            # the tail already wrapped, the free space ends at the head
+            fits = offset + size <= self.head
+        elif offset + size <= self.capacity:
+            fits = True
+        else:
+            # continue at the start of the data area, in front of the head
+            fits = _HEADER.size + size <= (self.head if self.records else self.capacity)
+            if fits:
+                if offset + _RECORD.size <= self.capacity:
+                    _RECORD.pack_into(self._map, offset, _WRAP, 0)
+                offset = _HEADER.size
+        if not fits:
+            self.dropped += len(readings)
+            self._write_header()
+            return False
+
+        _RECORD.pack_into(self._map, offset, len(body), len(readings))
+        self._map[offset + _RECORD.size:offset + size] = body
+        if not self.records:
+            self.head = offset
+
+        # the header is updated last, a record is only visible once it is complete
+        self.tail = offset + size
+        self.records += 1
+        self.pending += len(readings)
+        self.spilled += len(readings)
+        self._write_header()
+        return True
+
+    def take(self, max_readings):
+        """ Removes and returns the oldest spilled readings
+
+        Whole batches are taken until max_readings is reached, at least one batch when any is pending.
+
+        Returns:
+            list of readings, empty when nothing is pending
+        """
+        readings = []
+        while self.records and (not readings or len(readings) + self._next_count() <= max_readings):
+            offset = self._next_offset()
+            length, count = _RECORD.unpack_from(self._map, offset)
+            start = offset + _RECORD.size
+            readings.extend(_loads(self._map[start:start + length]))
+            self.head = start + length
+            self.records -= 1
+            self.pending -= count
+            self.drained += count
+        if not self.records:
+            self.head = self.tail = _HEADER.size
+        self._write_header()
+        return readings
+
+    def _next_offset(self):
+        """ Returns the offset of the oldest record, skipping a wrap at the end of the file """
+        offset = self.head
+        if offset + _RECORD.size > self.capacity or _RECORD.unpack_from(self._map, offset)[0] == _WRAP:
+            offset = _HEADER.size
+        return offset
+
+    def _next_count(self):
+        return _RECORD.unpack_from(self._map, self._next_offset())[1]
+
+    def update_rates(self):
+        """ Computes the spill and drain rates in readings per second since the previous call """
+        now = time.monotonic()
+        elapsed = now - self._rate_time
+        if elapsed > 0:
+            self.spill_rate = (self.spilled - self._rate_spilled) / elapsed
+            self.drain_rate = (self.drained - self._rate_drained) / elapsed
+        self._rate_time = now
+        self._rate_spilled = self.spilled
+        self._rate_drained = self.drained
+
+    def stats(self):
+        """ Returns the spill counters as a dictionary
+        """
+        return {
+            'pending': self.pending,
+            'spilled': self.spilled,
+            'drained': self.drained,
+            'dropped': self.dropped,
+            'spillRate': self.spill_rate,
+            'drainRate': self.drain_rate,
+            'usedBytes': self.used_bytes()
+        }
+
+    def used_bytes(self):
+        if not self.records:
+            return 0
+        if self.tail > self.head:
+            return self.tail - self.head
+        return self.capacity - self.head + self.tail - _HEADER.size
+
+    def close(self):
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None